@@ -0,0 +1,212 @@
+"""
+The bot end to end against fake_discord, no token or network needed.
+
+Every guild gets its layer channels and a member per spot, then each phase is run across all of them at once:
+
+    signin        a member per spot signs into it, sent as a message through on_message like discord would
+    signout       all of them sign out again
+    clear         everyone signs back in (not measured), then an admin clears every layer
+    update_channel    a re-render of every layer after a spot of it was taken
+    save_current_state / load_current_saved_state    of every guild
+
+and reports p50/p99 latency, the discord requests it took per command by kind and the throughput. Commands
+return before their deletes and re-renders go out, so the requests are counted and the throughput is timed
+until discord has been quiet for a while after the last one.
+
+    python benchmarks/bench_commands.py [--guilds 2] [--latency 20 80] [--no-rate-limits] [--backend json]
+"""
+import argparse
+import asyncio
+import logging
+import shutil
+import sys
+import tempfile
+import time
+import types
+from os import path
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+# settings.py exits without a token, we never talk to discord here
+sys.modules.setdefault("local_settings", types.ModuleType("local_settings"))
+sys.modules["local_settings"].DISCORD_TOKEN = None
+
+import fake_discord  # NOQA
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+class Phase:
+    def __init__(self, name, api):
+        self.name = name
+        self.api = api
+        self.latencies = []
+
+    async def __aenter__(self):
+        self.api.reset()
+        self.start = time.perf_counter()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.end = time.perf_counter()
+        await wait_until_quiet(self.api)
+        if self.api.last_call is not None and self.api.last_call > self.start:
+            self.end = max(self.end, self.api.last_call)
+
+    async def timed(self, coro):
+        start = time.perf_counter()
+        await coro
+        self.latencies.append(time.perf_counter() - start)
+
+    def report(self):
+        count = len(self.latencies)
+        calls = ", ".join(f"{kind} {calls / count:.2f}" for kind, calls in sorted(self.api.calls.items()))
+        print(
+            f"{self.name:<24} {count:>5} | p50 {percentile(self.latencies, 50) * 1000:>8.2f} ms "
+            f"p99 {percentile(self.latencies, 99) * 1000:>8.2f} ms | {count / (self.end - self.start):>8.1f}/s | "
+            f"{self.api.total_calls() / count:.2f} requests each ({calls or 'none'})"
+            + (f" | {self.api.rate_limited} rate limited" if self.api.rate_limited else "")
+        )
+
+
+async def wait_until_quiet(api):
+    """
+    Wait for everything the commands left in the background (debounced renders, batched deletes, DMs) to go out
+    """
+    from outbound import OutboundScheduler
+    from settings import FEEDBACK_WINDOW_SECONDS, OUTBOUND_DELETE_BATCH_SECONDS, RENDER_DEBOUNCE_SECONDS
+
+    quiet_for = max(RENDER_DEBOUNCE_SECONDS, OUTBOUND_DELETE_BATCH_SECONDS, FEEDBACK_WINDOW_SECONDS) + api.latency[1] + 0.5
+    while True:
+        await asyncio.sleep(0.1)
+        busy = any(stats["depth"] for stats in OutboundScheduler().stats().values())
+        if not busy and (api.last_call is None or time.perf_counter() - api.last_call >= quiet_for):
+            return
+
+
+def build_guild(guild_id, zone_channels, spots_per_layer, admin_role_id):
+    guild = fake_discord.Guild(guild_id)
+    for name in zone_channels:
+        guild.add_channel(name)
+    admin = guild.add_member(fake_discord.Member(guild_id * 10000, roles=[fake_discord.Role(admin_role_id)]))
+    members = [guild.add_member(fake_discord.Member(guild_id * 10000 + number)) for number in range(1, 1 + spots_per_layer)]
+    return guild, admin, members
+
+
+async def run(args, api):
+    import globals
+    import main
+    import storage
+    import utils
+    from globals import GlobalState, Guilds
+    from settings import ADMIN_ROLE_ID, EPL_SPOTS, PREFIX, ZONE_CHANNELS
+
+    storage.STATE_BACKEND = args.backend
+    Guilds().storage_factory = storage.get_storage
+
+    guilds = [build_guild(guild_id, ZONE_CHANNELS, len(EPL_SPOTS), ADMIN_ROLE_ID) for guild_id in range(1, args.guilds + 1)]
+    main.bot.guilds = [guild for guild, _, _ in guilds]
+    start = time.perf_counter()
+    await main.on_ready()
+    await wait_until_quiet(api)
+    print(
+        f"startup of {args.guilds} guilds x {len(ZONE_CHANNELS)} layers: {(api.last_call - start) * 1000:.0f} ms, "
+        f"{api.total_calls()} requests"
+    )
+
+    def send(channel, author, content):
+        return main.on_message(channel.post(content, author))
+
+    async def signin_everyone(phase):
+        await asyncio.gather(*[
+            phase.timed(send(channel, member, f"{PREFIX}signin {spot['number']}"))
+            for guild, _, members in guilds
+            for channel in guild.channels
+            for member, spot in zip(members, EPL_SPOTS)
+        ])
+
+    async with Phase("signin", api) as phase:
+        await signin_everyone(phase)
+    phase.report()
+
+    async with Phase("signout", api) as phase:
+        await asyncio.gather(*[
+            phase.timed(send(channel, member, f"{PREFIX}signout"))
+            for guild, _, members in guilds
+            for channel in guild.channels
+            for member in members
+        ])
+    phase.report()
+
+    async with Phase("(signin again)", api) as phase:
+        await signin_everyone(phase)
+    async with Phase("clear", api) as phase:
+        await asyncio.gather(*[
+            phase.timed(send(channel, admin, f"{PREFIX}clear")) for guild, admin, _ in guilds for channel in guild.channels
+        ])
+    phase.report()
+
+    async with Phase("update_channel", api) as phase:
+        for guild, _, members in guilds:
+            global_state = Guilds().get(guild.id)
+            for channel, member in zip(guild.channels, members):
+                # Something to render, the embed cache skips edits that wouldnt change anything
+                zone_name, layer_num, _ = global_state.get_state_for_channel(channel)
+                global_state.signin_spots(zone_name, layer_num, [1], member.id)
+                global_state.mark_mutated(channel)
+        await asyncio.gather(*[
+            phase.timed(utils.update_channel(channel)) for guild, _, _ in guilds for channel in guild.channels
+        ])
+    phase.report()
+
+    async with Phase("save_current_state", api) as phase:
+        for guild, _, _ in guilds:
+            start = time.perf_counter()
+            Guilds().get(guild.id).save_current_state()
+            phase.latencies.append(time.perf_counter() - start)
+    phase.report()
+
+    async with Phase("load_current_saved_state", api) as phase:
+        for guild, _, _ in guilds:
+            # Loaded into a copy, loading drops the discord objects of the live state
+            global_state = GlobalState()
+            global_state.guild_id = guild.id
+            global_state.save_fp = globals.guild_path(guild.id, globals.SAVE_FILENAME)
+            global_state.storage = storage.get_storage(global_state)
+            start = time.perf_counter()
+            global_state.load_current_saved_state()
+            phase.latencies.append(time.perf_counter() - start)
+    phase.report()
+
+    Guilds().close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--guilds", type=int, default=2)
+    parser.add_argument("--latency", type=float, nargs=2, default=(20, 80), metavar=("MIN_MS", "MAX_MS"))
+    parser.add_argument("--no-rate-limits", action="store_true", help="discord never makes a request wait")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    rate_limits = {kind: None for kind in fake_discord.DEFAULT_RATE_LIMITS} if args.no_rate_limits else None
+    api = fake_discord.install(latency=(args.latency[0] / 1000, args.latency[1] / 1000), rate_limits=rate_limits)
+
+    import globals
+    globals.ABSOLUTE_GUILD_STATE_FP = tempfile.mkdtemp()
+    print(
+        f"{args.guilds} guilds, {args.backend} state, {args.latency[0]:.0f}-{args.latency[1]:.0f} ms per request, "
+        f"{'no' if args.no_rate_limits else 'discord'} rate limits"
+    )
+    try:
+        asyncio.run(run(args, api))
+    finally:
+        shutil.rmtree(globals.ABSOLUTE_GUILD_STATE_FP)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Stress test for signins racing for the same spots: hundreds of them, run through the real signin command by handing
+them to on_message against fake_discord.
+
+Every guild gets its layer channels and --signins members, each picking a random spot of a random layer, and they
+all send their signin at once. Once the confirmation DMs are out it reports how many spots were confirmed to more
+than one player, how many spots were taken and the signin latency and throughput.
+
+Validating and assigning a signin is atomic because GlobalState.claim_spots does both without awaiting, so no
+other command can run in between. The run fails if a spot was confirmed twice - something awaits between the two -
+or if a signin took as long as confirming every spot of its layer one after the other would, which is what a
+signin waiting on its confirmation DM looks like.
+
+    python benchmarks/bench_concurrent_signin.py [--guilds 4] [--signins 200] [--latency 20 80] [--no-rate-limits]
+"""
+import argparse
+import asyncio
+import logging
+import random
+import shutil
+import sys
+import tempfile
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+
+from bench_commands import percentile, wait_until_quiet  # NOQA
+import fake_discord  # NOQA
+
+
+async def run(args, api):
+    import main
+    import storage
+    from globals import Guilds
+    from settings import EPL_SPOTS, PREFIX, ZONE_CHANNELS
+
+    Guilds().storage_factory = storage.get_storage
+
+    rng = random.Random(1)
+    # (channel, spot number, member) of every signin
+    attempts = []
+    for guild_id in range(1, args.guilds + 1):
+        guild = fake_discord.Guild(guild_id)
+        channels = [guild.add_channel(name) for name in ZONE_CHANNELS]
+        for number in range(1, args.signins + 1):
+            member = guild.add_member(fake_discord.Member(guild_id * 100000 + number))
+            attempts.append((rng.choice(channels), rng.choice(EPL_SPOTS)["number"], member))
+        main.bot.guilds.append(guild)
+    await main.on_ready()
+    await wait_until_quiet(api)
+
+    latencies = []
+
+    async def signin(channel, spot_num, member):
+        start = time.perf_counter()
+        await main.on_message(channel.post(f"{PREFIX}signin {spot_num}", member))
+        latencies.append(time.perf_counter() - start)
+
+    api.reset()
+    start = time.perf_counter()
+    await asyncio.gather(*[signin(*attempt) for attempt in attempts])
+    elapsed = time.perf_counter() - start
+    await wait_until_quiet(api)
+
+    # (channel id, spot number) -> members the bot confirmed it to
+    confirmed = {}
+    for channel, spot_num, member in attempts:
+        if member.dm_channel is None:
+            continue
+        if any(message.content.startswith("Sign in confirmed!") for message in member.dm_channel.messages.values()):
+            confirmed.setdefault((channel.id, spot_num), []).append(member.id)
+    double_confirmed = sum(1 for members in confirmed.values() if len(members) > 1)
+    taken = sum(
+        len(layer.spots) - layer.free_count()
+        for guild in main.bot.guilds
+        for zone in Guilds().get(guild.id).state.values()
+        for layer in zone.layers.values()
+    )
+    p99 = percentile(latencies, 99)
+    print(
+        f"{len(attempts)} signins in {elapsed * 1000:>6.0f} ms ({len(attempts) / elapsed:>6.0f}/s) | "
+        f"p50 {percentile(latencies, 50) * 1000:.2f} ms p99 {p99 * 1000:.2f} ms | {taken} spots taken, "
+        f"{len(confirmed)} confirmed | {double_confirmed} spots confirmed to more than one player"
+    )
+    Guilds().close()
+
+    assert double_confirmed == 0, "A spot was confirmed twice - something awaits between validating and assigning"
+    assert len(confirmed) == taken, "Not every spot taken was confirmed"
+    assert p99 < len(EPL_SPOTS) * api.latency[1], "Signins waited on discord"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--guilds", type=int, default=4)
+    parser.add_argument("--signins", type=int, default=200, help="per guild")
+    parser.add_argument("--latency", type=float, nargs=2, default=(20, 80), metavar=("MIN_MS", "MAX_MS"))
+    parser.add_argument("--no-rate-limits", action="store_true", help="discord never makes a request wait")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    rate_limits = {kind: None for kind in fake_discord.DEFAULT_RATE_LIMITS} if args.no_rate_limits else None
+    api = fake_discord.install(latency=(args.latency[0] / 1000, args.latency[1] / 1000), rate_limits=rate_limits)
+
+    import globals
+    globals.ABSOLUTE_GUILD_STATE_FP = tempfile.mkdtemp()
+    print(
+        f"{args.guilds} guilds x {args.signins} signins, {args.latency[0]:.0f}-{args.latency[1]:.0f} ms per request, "
+        f"{'no' if args.no_rate_limits else 'discord'} rate limits"
+    )
+    try:
+        asyncio.run(run(args, api))
+    finally:
+        shutil.rmtree(globals.ABSOLUTE_GUILD_STATE_FP)
+
+
+if __name__ == "__main__":
+    main()
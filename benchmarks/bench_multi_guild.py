@@ -0,0 +1,144 @@
+"""
+Loading and looking up the state of 50 guilds, each with 5 zones x 10 layers x 10 spots, from their own
+directories with both storage backends.
+
+For each backend every guild is saved through its storage, then a fresh Guilds registry loads them all back.
+Reports the total and per guild load times, the memory the loaded states take and how fast a channel is mapped
+to its guild and layer.
+
+    python benchmarks/bench_multi_guild.py
+"""
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+# settings.py exits without a token, we never talk to discord here
+sys.modules.setdefault("local_settings", types.ModuleType("local_settings"))
+sys.modules["local_settings"].DISCORD_TOKEN = None
+
+import globals  # NOQA
+import storage  # NOQA
+from globals import GlobalState, Guilds, Layer, SingletonMetaclass, Zone, guild_path  # NOQA
+
+NUM_GUILDS = 50
+NUM_ZONES = 5
+NUM_LAYERS = 10
+NUM_SPOTS = 10
+LOOKUPS = 200000
+
+SPOTS_INFO = [{"name": f"Spot {number}", "number": number} for number in range(1, NUM_SPOTS + 1)]
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class FakeChannel:
+    def __init__(self, channel_id, name, guild):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+
+
+def build_guild(guild_id):
+    """
+    A guild with every layer attached to a channel and every other spot taken, returns it and its channels
+    """
+    guild = FakeGuild(guild_id)
+    global_state = GlobalState()
+    global_state.guild_id = guild_id
+    global_state.save_fp = guild_path(guild_id, globals.SAVE_FILENAME)
+    global_state.state = {}
+    for zone_number in range(NUM_ZONES):
+        zone_name = f"zone-{zone_number}"
+        global_state.state[zone_name] = Zone(zone_name)
+        for layer_number in range(1, NUM_LAYERS + 1):
+            layer = Layer.fresh(f"{zone_name}-layer-{layer_number}", SPOTS_INFO)
+            layer.table_message = 10 ** 17 + layer_number
+            layer.status_message = 10 ** 17 + layer_number
+            for spot in layer.spots.values():
+                if spot.number % 2:
+                    spot.player = 10 ** 17 + guild_id * 1000 + spot.number
+            global_state.state[zone_name].layers[layer_number] = layer
+    global_state.index_channels()
+    global_state.index_players()
+
+    channels = []
+    for zone_name, zone in global_state.state.items():
+        for layer_number, layer in zone.layers.items():
+            channel = FakeChannel(guild_id * 10000 + len(channels), layer.channel_name, guild)
+            global_state.set_layer_channel(layer, channel)
+            channels.append(channel)
+    return global_state, channels
+
+
+def fresh_guilds():
+    SingletonMetaclass._instances.pop(Guilds, None)
+    guilds = Guilds()
+    guilds.storage_factory = storage.get_storage
+    return guilds
+
+
+def run(backend):
+    storage.STATE_BACKEND = backend
+    globals.ABSOLUTE_GUILD_STATE_FP = tempfile.mkdtemp()
+    try:
+        channels = []
+        start = time.perf_counter()
+        for guild_id in range(1, NUM_GUILDS + 1):
+            global_state, guild_channels = build_guild(guild_id)
+            channels.extend(guild_channels)
+            storage.get_storage(global_state).close(global_state)
+        save_time = time.perf_counter() - start
+
+        tracemalloc.start()
+        guilds = fresh_guilds()
+        for guild_id in range(1, NUM_GUILDS + 1):
+            guilds.get(guild_id)
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        guilds.close()
+
+        guilds = fresh_guilds()
+        load_times = []
+        for guild_id in range(1, NUM_GUILDS + 1):
+            start = time.perf_counter()
+            guilds.get(guild_id)
+            load_times.append(time.perf_counter() - start)
+
+        # Loaded states only know their channels by name until on_ready attaches them
+        for channel in channels:
+            global_state = guilds.for_channel(channel)
+            _, _, layer = global_state.get_state_for_channel(channel.name)
+            global_state.set_layer_channel(layer, channel)
+        start = time.perf_counter()
+        for index in range(LOOKUPS):
+            channel = channels[index % len(channels)]
+            guilds.for_channel(channel).get_state_for_channel(channel)
+        lookup_time = time.perf_counter() - start
+
+        guilds.close()
+        print(
+            f"{backend:<7} save all {save_time * 1000:>7.1f} ms | load all {sum(load_times) * 1000:>7.1f} ms "
+            f"(p50 {statistics.median(load_times) * 1000:.2f} ms, max {max(load_times) * 1000:.2f} ms per guild) | "
+            f"memory {memory / 1024:>6.0f} KiB | lookup {lookup_time / LOOKUPS * 10 ** 6:.2f} us"
+        )
+    finally:
+        shutil.rmtree(globals.ABSOLUTE_GUILD_STATE_FP)
+
+
+def main():
+    print(f"{NUM_GUILDS} guilds x {NUM_ZONES} zones x {NUM_LAYERS} layers x {NUM_SPOTS} spots")
+    for backend in ("json", "sqlite"):
+        run(backend)
+
+
+if __name__ == "__main__":
+    main()
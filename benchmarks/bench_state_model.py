@@ -0,0 +1,164 @@
+"""
+Memory and throughput of the slotted Zone/Layer/LotusSpot state model against the DotMap tree it replaced,
+at 100 zones x 10 layers x 10 spots.
+
+    python benchmarks/bench_state_model.py
+
+The DotMap side needs `pip install dotmap==1.3.14` and is skipped without it.
+"""
+import json
+import sys
+import time
+import tracemalloc
+import types
+from dataclasses import dataclass, fields
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+# settings.py exits without a token, we never talk to discord here
+sys.modules.setdefault("local_settings", types.ModuleType("local_settings"))
+sys.modules["local_settings"].DISCORD_TOKEN = None
+
+from globals import GlobalState, Layer, Zone  # NOQA
+
+try:
+    from dotmap import DotMap
+except ImportError:
+    DotMap = None
+
+NUM_ZONES = 100
+NUM_LAYERS = 10
+NUM_SPOTS = 10
+REPEATS = 20
+
+SPOTS_INFO = [{"name": f"Spot {number}", "number": number} for number in range(1, NUM_SPOTS + 1)]
+
+
+def build_slotted():
+    state = {}
+    for zone_number in range(NUM_ZONES):
+        zone_name = f"zone-{zone_number}"
+        zone = Zone(zone_name)
+        for layer_number in range(1, NUM_LAYERS + 1):
+            layer = Layer.fresh(f"{zone_name}-layer-{layer_number}", SPOTS_INFO)
+            layer.table_message = 10 ** 17 + layer_number
+            layer.status_message = 10 ** 17 + layer_number
+            for spot in layer.spots.values():
+                if spot.number % 2:
+                    spot.player = 10 ** 17 + spot.number
+            zone.layers[layer_number] = layer
+        state[zone_name] = zone
+    return state
+
+
+@dataclass
+class DotMapLotusSpot:
+    name: str
+    number: int
+    player: int
+
+
+def build_dotmap():
+    """
+    The tree the way GlobalState.fresh_init used to build it
+    """
+    state = DotMap(_dynamic=True)
+    for zone_number in range(NUM_ZONES):
+        zone_name = f"zone-{zone_number}"
+        state[zone_name] = DotMap()
+        state[zone_name].layers = DotMap()
+        for layer in range(1, NUM_LAYERS + 1):
+            state[zone_name].layers[layer].channel = None
+            state[zone_name].layers[layer].table_message = 10 ** 17 + layer
+            state[zone_name].layers[layer].status_message = 10 ** 17 + layer
+            state[zone_name].layers[layer].spots = DotMap()
+            state[zone_name].layers[layer].channel_name = f"{zone_name}-layer-{layer}"
+            state[zone_name].layers[layer].timer = None
+            for spot in SPOTS_INFO:
+                state[zone_name].layers[layer].spots[spot["number"]] = DotMapLotusSpot(
+                    name=spot["name"],
+                    number=spot["number"],
+                    player=10 ** 17 + spot["number"] if spot["number"] % 2 else None,
+                )
+    return DotMap(state, _dynamic=False)
+
+
+def dotmap_serialize(state):
+    def serializer(obj):
+        if isinstance(obj, DotMapLotusSpot):
+            return {field.name: getattr(obj, field.name) for field in fields(obj)}
+        if isinstance(obj, DotMap):
+            return obj.toDict()
+
+    # json.dump rather than json.dumps, the one-shot encoder sees DotMaps as empty dicts
+    return "".join(json.JSONEncoder(default=serializer).iterencode({"state": state}))
+
+
+def dotmap_load(data):
+    state = DotMap(json.loads(data)["state"], _dynamic=False)
+    for zone in state:
+        for layer in state[zone].layers:
+            for spot in state[zone].layers[layer].spots:
+                state[zone].layers[layer].spots[spot] = DotMapLotusSpot(**state[zone].layers[layer].spots[spot])
+    return state
+
+
+def count_free(state):
+    return sum(
+        1
+        for zone in state.values()
+        for layer in zone.layers.values()
+        for spot in layer.spots.values()
+        if spot.player is None
+    )
+
+
+def measure_memory(build):
+    tracemalloc.start()
+    state = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return state, current
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        result = func(*args)
+    return (time.perf_counter() - start) / REPEATS, result
+
+
+def run(name, build, serialize, load):
+    state, memory = measure_memory(build)
+    build_time, _ = timed(build)
+    serialize_time, data = timed(serialize, state)
+    load_time, _ = timed(load, data)
+    scan_time, free = timed(count_free, state)
+    print(
+        f"{name:<8} memory {memory / 1024:>8.0f} KiB | build {build_time * 1000:>7.1f} ms | "
+        f"serialize {serialize_time * 1000:>7.1f} ms | load {load_time * 1000:>7.1f} ms | "
+        f"scan {scan_time * 1000:>6.2f} ms | {len(data) / 1024:.0f} KiB on disk, {free} free spots"
+    )
+
+
+def main():
+    print(f"{NUM_ZONES} zones x {NUM_LAYERS} layers x {NUM_SPOTS} spots, mean of {REPEATS} runs")
+
+    global_state = GlobalState()
+
+    def slotted_serialize(state):
+        global_state.state = state
+        return global_state.serialize()
+
+    def slotted_load(data):
+        return global_state._load_state(json.loads(data))
+
+    run("slotted", build_slotted, slotted_serialize, slotted_load)
+    if DotMap is None:
+        print("dotmap isnt installed - skipping the DotMap comparison")
+        return
+    run("DotMap", build_dotmap, dotmap_serialize, dotmap_load)
+
+
+if __name__ == "__main__":
+    main()
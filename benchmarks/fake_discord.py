@@ -0,0 +1,479 @@
+"""
+In-process stand-in for the parts of discord.py the bot uses, so it can be driven without a token or a network.
+
+    import fake_discord
+    api = fake_discord.install(latency=(0.02, 0.08))
+    import main  # NOQA - picks up the fake as discord
+
+Every request the bot makes (sends, edits, deletes, reactions, DMs...) goes through the FakeAPI returned by install().
+It sleeps for a random latency and is held to per route rate limits the way discord.py does it, by waiting until
+the bucket refills. The API counts every call by kind so a benchmark can tell how many requests a command cost,
+and by whatever the caller contextvar was set to when the request was made.
+"""
+import asyncio
+import contextvars
+import enum
+import itertools
+import random
+import sys
+import time
+import types
+
+# (requests, per seconds) of each kind of request, per channel like discord does it. DM channels included
+DEFAULT_RATE_LIMITS = {
+    "send": (5, 5.0),
+    "edit": (5, 5.0),
+    "delete": (5, 1.0),
+    "bulk_delete": (1, 1.0),
+    "react": (1, 0.25),
+    "fetch": (50, 1.0),
+    "purge": (1, 1.0),
+    "create_dm": (50, 1.0),
+    "dm": (5, 5.0),
+}
+
+_ids = itertools.count(10 ** 17)
+
+# Who the requests made in this context are on behalf of, e.g. the command being run. None for everything else
+caller = contextvars.ContextVar("caller", default=None)
+
+
+class FakeAPI:
+    """
+    Simulated discord REST API. latency is a (min, max) range in seconds, rate_limits as DEFAULT_RATE_LIMITS
+    """
+
+    def __init__(self, latency=(0.0, 0.0), rate_limits=None, seed=0):
+        self.latency = latency
+        self.rate_limits = dict(DEFAULT_RATE_LIMITS, **(rate_limits or {}))
+        self.random = random.Random(seed)
+        # kind -> calls made, and caller -> kind -> calls made
+        self.calls = {}
+        self.calls_by_caller = {}
+        # How many calls had to wait for their bucket, and for how long in total
+        self.rate_limited = 0
+        self.rate_limited_seconds = 0.0
+        # route -> (requests left, when the bucket refills)
+        self._buckets = {}
+        self.last_call = None
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def reset(self):
+        self.calls = {}
+        self.calls_by_caller = {}
+        self.rate_limited = 0
+        self.rate_limited_seconds = 0.0
+
+    async def request(self, kind, route):
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        caller_calls = self.calls_by_caller.setdefault(caller.get(), {})
+        caller_calls[kind] = caller_calls.get(kind, 0) + 1
+        limit = self.rate_limits.get(kind)
+        if limit is not None:
+            await self._wait_for_bucket((kind, route), limit)
+        low, high = self.latency
+        if high > 0:
+            await asyncio.sleep(self.random.uniform(low, high))
+        self.last_call = time.perf_counter()
+
+    async def _wait_for_bucket(self, key, limit):
+        requests, per = limit
+        while True:
+            now = time.monotonic()
+            left, reset_at = self._buckets.get(key, (requests, now + per))
+            if now >= reset_at:
+                left, reset_at = requests, now + per
+            if left > 0:
+                self._buckets[key] = (left - 1, reset_at)
+                return
+            self.rate_limited += 1
+            self.rate_limited_seconds += reset_at - now
+            await asyncio.sleep(reset_at - now)
+
+
+_api = FakeAPI()
+
+
+def install(latency=(0.0, 0.0), rate_limits=None, seed=0):
+    """
+    Make this module importable as discord and discord.ext.commands, returns the FakeAPI every request goes to.
+    Has to run before anything imports discord
+    """
+    global _api
+    _api = FakeAPI(latency, rate_limits, seed)
+    module = sys.modules[__name__]
+    sys.modules["discord"] = module
+    sys.modules["discord.ext"] = ext
+    sys.modules["discord.ext.commands"] = commands
+    return _api
+
+
+class DiscordException(Exception):
+    pass
+
+
+class HTTPException(DiscordException):
+    pass
+
+
+class NotFound(HTTPException):
+    pass
+
+
+class Forbidden(HTTPException):
+    pass
+
+
+class ChannelType(enum.Enum):
+    text = 0
+    private = 1
+
+
+class Object:
+    def __init__(self, id):
+        self.id = id
+
+
+class Embed:
+    def __init__(self, title=None, description=None):
+        self.title = title
+        self.description = description
+        self.fields = []
+
+    def add_field(self, name, value, inline=True):
+        self.fields.append({"name": name, "value": value, "inline": inline})
+        return self
+
+    def to_dict(self):
+        data = {"type": "rich", "fields": self.fields}
+        if self.title is not None:
+            data["title"] = self.title
+        if self.description is not None:
+            data["description"] = self.description
+        return data
+
+
+class PartialEmoji:
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class Reaction:
+    def __init__(self, emoji, me):
+        self.emoji = emoji
+        self.me = me
+
+
+class RawReactionActionEvent:
+    def __init__(self, message_id, channel_id, guild_id, user_id, emoji):
+        self.message_id = message_id
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.emoji = PartialEmoji(emoji)
+
+
+class Role:
+    def __init__(self, id, name="role"):
+        self.id = id
+        self.name = name
+
+
+class Member:
+    def __init__(self, id, name=None, guild=None, roles=()):
+        self.id = id
+        self.name = name or f"user-{id}"
+        self.display_name = self.name
+        self.guild = guild
+        self.roles = list(roles)
+        self.bot = False
+        self.dm_channel = None
+
+    @property
+    def mention(self):
+        return f"<@{self.id}>"
+
+    def __str__(self):
+        return self.name
+
+    async def create_dm(self):
+        await _api.request("create_dm", None)
+        if self.dm_channel is None:
+            self.dm_channel = DMChannel(self)
+        return self.dm_channel
+
+
+User = Member
+
+
+class Message:
+    def __init__(self, channel, content="", author=None, embed=None):
+        self.id = next(_ids)
+        self.channel = channel
+        self.guild = getattr(channel, "guild", None)
+        self.content = content
+        self.author = author
+        self.embeds = [embed] if embed is not None else []
+        self.reactions = []
+        self.created_at = time.time()
+
+    def _route(self):
+        return self.channel.id
+
+    async def edit(self, content=None, embed=None):
+        await _api.request("edit", self._route())
+        if content is not None:
+            self.content = content
+        if embed is not None:
+            self.embeds = [embed]
+
+    async def delete(self):
+        await _api.request("delete", self._route())
+        if self.channel.messages.pop(self.id, None) is None:
+            raise NotFound(f"Unknown message {self.id}")
+
+    async def add_reaction(self, emoji):
+        await _api.request("react", self._route())
+        self.reactions.append(Reaction(emoji, True))
+
+    async def remove_reaction(self, emoji, member):
+        await _api.request("react", self._route())
+        self.reactions = [reaction for reaction in self.reactions if str(reaction.emoji) != str(emoji)]
+
+    async def clear_reactions(self):
+        await _api.request("react", self._route())
+        self.reactions = []
+
+
+class TextChannel:
+    def __init__(self, name, guild=None):
+        self.id = next(_ids)
+        self.name = name
+        self.guild = guild
+        self.type = ChannelType.text
+        # message id -> Message, everything sent here that wasnt deleted
+        self.messages = {}
+
+    @property
+    def mention(self):
+        return f"<#{self.id}>"
+
+    def __str__(self):
+        return self.name
+
+    def post(self, content, author):
+        """
+        A message from a user showing up in the channel, costs no request
+        """
+        message = Message(self, content, author)
+        self.messages[message.id] = message
+        return message
+
+    async def send(self, content=None, embed=None):
+        await _api.request("send", self.id)
+        message = Message(self, content or "", _api_user, embed)
+        self.messages[message.id] = message
+        return message
+
+    async def fetch_message(self, id):
+        await _api.request("fetch", self.id)
+        try:
+            return self.messages[id]
+        except KeyError:
+            raise NotFound(f"Unknown message {id}")
+
+    async def purge(self, limit=None):
+        await _api.request("purge", self.id)
+        self.messages.clear()
+
+    async def delete_messages(self, messages):
+        await _api.request("bulk_delete", self.id)
+        for message in messages:
+            self.messages.pop(message.id, None)
+
+
+class DMChannel(TextChannel):
+    def __init__(self, recipient):
+        super().__init__(f"dm-{recipient.id}")
+        self.type = ChannelType.private
+        self.recipient = recipient
+
+    async def send(self, content=None, embed=None):
+        await _api.request("dm", self.id)
+        message = Message(self, content or "", _api_user, embed)
+        self.messages[message.id] = message
+        return message
+
+
+class Guild:
+    def __init__(self, id=None, name=None):
+        self.id = id if id is not None else next(_ids)
+        self.name = name or f"guild-{self.id}"
+        self.channels = []
+        self._members = {}
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    def add_channel(self, name):
+        channel = TextChannel(name, self)
+        self.channels.append(channel)
+        return channel
+
+    def add_member(self, member):
+        member.guild = self
+        self._members[member.id] = member
+        return member
+
+    def get_member(self, id):
+        return self._members.get(id)
+
+    def get_channel(self, id):
+        return next((channel for channel in self.channels if channel.id == id), None)
+
+
+# The bot itself, author of everything it sends
+_api_user = Member(1, "LotusMafiaBot")
+
+
+"""
+discord.ext.commands
+"""
+
+
+class CommandError(DiscordException):
+    pass
+
+
+class CommandNotFound(CommandError):
+    pass
+
+
+class CheckFailure(CommandError):
+    pass
+
+
+class MissingRole(CheckFailure):
+    def __init__(self, missing_role):
+        self.missing_role = missing_role
+        super().__init__(f"Role {missing_role} is required to run this command")
+
+
+class CommandInvokeError(CommandError):
+    def __init__(self, original):
+        self.original = original
+        super().__init__(f"Command raised an exception: {original!r}")
+
+
+def has_role(role_id):
+    def check(ctx):
+        if not any(role.id == role_id for role in getattr(ctx.author, "roles", ())):
+            raise MissingRole(role_id)
+        return True
+
+    def decorator(func):
+        func.__commands_checks__ = getattr(func, "__commands_checks__", []) + [check]
+        return func
+    return decorator
+
+
+class Command:
+    def __init__(self, callback, name=None):
+        self.callback = callback
+        self.name = name or callback.__name__
+        self.checks = getattr(callback, "__commands_checks__", [])
+
+    def __str__(self):
+        return self.name
+
+
+class Context:
+    def __init__(self, bot, message, command=None):
+        self.bot = bot
+        self.message = message
+        self.channel = message.channel
+        self.author = message.author
+        self.guild = message.guild
+        self.command = command
+
+
+class Bot:
+    """
+    Parses commands the way discord.ext.commands does for the plain positional string arguments the bot uses
+    """
+
+    def __init__(self, command_prefix, **options):
+        self.command_prefix = command_prefix
+        self.shard_id = options.get("shard_id")
+        self.shard_count = options.get("shard_count")
+        self.commands = {}
+        self.guilds = []
+        self.user = _api_user
+        self.latency = 0.0
+        self.loop = None
+
+    def remove_command(self, name):
+        return self.commands.pop(name, None)
+
+    def command(self, name=None, **kwargs):
+        def decorator(func):
+            command = Command(func, name)
+            self.commands[command.name] = command
+            return command
+        return decorator
+
+    def event(self, coro):
+        setattr(self, coro.__name__, coro)
+        return coro
+
+    def get_guild(self, id):
+        return next((guild for guild in self.guilds if guild.id == id), None)
+
+    def get_channel(self, id):
+        for guild in self.guilds:
+            channel = guild.get_channel(id)
+            if channel is not None:
+                return channel
+        return None
+
+    async def process_commands(self, message):
+        if not message.content.startswith(self.command_prefix):
+            return
+        name, *args = message.content[len(self.command_prefix):].split()
+        command = self.commands.get(name)
+        ctx = Context(self, message, command)
+        try:
+            if command is None:
+                raise CommandNotFound(f'Command "{name}" is not found')
+            for check in command.checks:
+                check(ctx)
+            try:
+                await command.callback(ctx, *args)
+            except CommandError:
+                raise
+            except Exception as e:
+                raise CommandInvokeError(e) from e
+        except CommandError as e:
+            on_command_error = getattr(self, "on_command_error", None)
+            if on_command_error is None:
+                raise
+            await on_command_error(ctx, e)
+
+    def run(self, token):
+        raise RuntimeError("The fake bot never connects, drive it through its events")
+
+
+commands = types.ModuleType("discord.ext.commands")
+for _name in (
+    "Bot", "Command", "CommandError", "CommandInvokeError", "CommandNotFound", "CheckFailure", "Context", "MissingRole",
+    "has_role",
+):
+    setattr(commands, _name, globals()[_name])
+ext = types.ModuleType("discord.ext")
+ext.commands = commands
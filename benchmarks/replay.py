@@ -0,0 +1,187 @@
+"""
+Replays an event log written by recorder.EventRecorder (RECORD_EVENTS in settings.py) against fake_discord.
+
+The recorded guilds, channels and members are rebuilt in the fake, the guilds start up fresh and every recorded
+message is fed through on_message again - at the pace it was recorded (sped up by --speed) or, with --fast, all
+of them as fast as they can be handed over. Reports the end to end latency of every command, the discord requests
+made on its behalf and those made outside of any command, and how many command errors the replay ran into next to
+how many were recorded.
+
+    python benchmarks/replay.py lotus_events.jsonl [--fast | --speed 10] [--latency 20 80] [--no-rate-limits]
+
+Requests a command queued run in its context, see outbound._Job, so they are counted for it even when they go
+out later. Shared work is counted for whoever started it: a bulk delete for the command whose delete was first, a
+debounced re-render for the command that marked the layer dirty first.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import shutil
+import sys
+import tempfile
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+
+from bench_commands import percentile, wait_until_quiet  # NOQA
+import fake_discord  # NOQA
+
+
+def load_events(fp):
+    """
+    (messages, recorded error counts by type), messages in the order they were recorded
+    """
+    messages = []
+    errors = {}
+    with open(fp, "r") as f:
+        for line_number, line in enumerate(f, start=1):
+            try:
+                event = json.loads(line)
+            except ValueError:
+                print(f"Skipping unreadable line {line_number}")
+                continue
+            if event["ev"] == "message":
+                messages.append(event)
+            elif event["ev"] == "error":
+                errors[event["error"]] = errors.get(event["error"], 0) + 1
+    messages.sort(key=lambda event: event["t"])
+    return messages, errors
+
+
+def build_guilds(messages, zone_channels):
+    """
+    The guilds as far as the log knows them, every one with all the layer channels so it can start up
+    """
+    guilds = {}
+    channels = {}
+    members = {}
+    for event in messages:
+        guild = guilds.get(event["guild"])
+        if guild is None:
+            guild = guilds[event["guild"]] = fake_discord.Guild(event["guild"])
+            for name in zone_channels:
+                channels[(guild.id, name)] = guild.add_channel(name)
+        if (guild.id, event["channel"]) not in channels:
+            channels[(guild.id, event["channel"])] = guild.add_channel(event["channel"])
+        if (guild.id, event["author"]) not in members:
+            members[(guild.id, event["author"])] = guild.add_member(fake_discord.Member(
+                event["author"], roles=[fake_discord.Role(role_id) for role_id in event.get("roles", ())]
+            ))
+    return list(guilds.values()), channels, members
+
+
+def command_name(content, prefix):
+    if not content.startswith(prefix) or not content[len(prefix):].split():
+        return "(not a command)"
+    return content[len(prefix):].split()[0]
+
+
+async def run(args, api):
+    import main
+    import storage
+    from globals import Guilds
+    from recorder import EventRecorder
+    from settings import PREFIX, ZONE_CHANNELS
+
+    # Replaying a log shouldnt write another one
+    EventRecorder().enabled = False
+    Guilds().storage_factory = storage.get_storage
+
+    messages, recorded_errors = load_events(args.log)
+    if not messages:
+        print("No messages in the log")
+        return
+    guilds, channels, members = build_guilds(messages, ZONE_CHANNELS)
+    main.bot.guilds = guilds
+    await main.on_ready()
+    await wait_until_quiet(api)
+
+    replayed_errors = {}
+    on_command_error = main.bot.on_command_error
+
+    async def counting_on_command_error(context, exception):
+        replayed_errors[type(exception).__name__] = replayed_errors.get(type(exception).__name__, 0) + 1
+        await on_command_error(context, exception)
+    main.bot.on_command_error = counting_on_command_error
+
+    # command -> end to end latencies
+    latencies = {}
+
+    async def dispatch(event):
+        name = command_name(event["content"], PREFIX)
+        fake_discord.caller.set(name)
+        channel = channels[(event["guild"], event["channel"])]
+        message = channel.post(event["content"], members[(event["guild"], event["author"])])
+        start = time.perf_counter()
+        await main.on_message(message)
+        latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+    api.reset()
+    first = messages[0]["t"]
+    start = time.perf_counter()
+    tasks = []
+    for event in messages:
+        if not args.fast:
+            delay = start + (event["t"] - first) / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(dispatch(event)))
+    await asyncio.gather(*tasks)
+    handled = time.perf_counter()
+    await wait_until_quiet(api)
+    end = max(handled, api.last_call or handled)
+
+    print(
+        f"{len(messages)} messages recorded over {messages[-1]['t'] - first:.1f} s, replayed in {end - start:.1f} s | "
+        f"{api.total_calls()} requests" + (f", {api.rate_limited} rate limited" if api.rate_limited else "")
+    )
+    for name, command_latencies in sorted(latencies.items()):
+        count = len(command_latencies)
+        calls = api.calls_by_caller.get(name, {})
+        print(
+            f"{name:<16} {count:>5} | p50 {percentile(command_latencies, 50) * 1000:>8.2f} ms "
+            f"p99 {percentile(command_latencies, 99) * 1000:>8.2f} ms "
+            f"max {max(command_latencies) * 1000:>8.2f} ms | {sum(calls.values()) / count:.2f} requests each ("
+            + (", ".join(f"{kind} {kind_calls / count:.2f}" for kind, kind_calls in sorted(calls.items())) or "none")
+            + ")"
+        )
+    background = api.calls_by_caller.get(None, {})
+    print(
+        f"{'(background)':<16} {sum(background.values()):>5} requests ("
+        + (", ".join(f"{kind} {calls}" for kind, calls in sorted(background.items())) or "none") + ")"
+    )
+    for error in sorted(set(recorded_errors) | set(replayed_errors)):
+        print(f"{error:<24} recorded {recorded_errors.get(error, 0):>5} | replayed {replayed_errors.get(error, 0):>5}")
+
+    Guilds().close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log", help="event log written with RECORD_EVENTS on")
+    pace = parser.add_mutually_exclusive_group()
+    pace.add_argument("--fast", action="store_true", help="hand every message over straight away")
+    pace.add_argument("--speed", type=float, default=1.0, help="replay this many times faster than recorded")
+    parser.add_argument("--latency", type=float, nargs=2, default=(20, 80), metavar=("MIN_MS", "MAX_MS"))
+    parser.add_argument("--no-rate-limits", action="store_true", help="discord never makes a request wait")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    rate_limits = {kind: None for kind in fake_discord.DEFAULT_RATE_LIMITS} if args.no_rate_limits else None
+    api = fake_discord.install(latency=(args.latency[0] / 1000, args.latency[1] / 1000), rate_limits=rate_limits)
+
+    import globals
+    import storage
+    storage.STATE_BACKEND = args.backend
+    globals.ABSOLUTE_GUILD_STATE_FP = tempfile.mkdtemp()
+    try:
+        asyncio.run(run(args, api))
+    finally:
+        shutil.rmtree(globals.ABSOLUTE_GUILD_STATE_FP)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,78 @@
-from functools import wraps
+import logging
+import time
+from functools import partial, wraps
 
-from globals import GlobalState
-from utils import update_channel, get_user_dm
+from dms import Feedback
+from globals import Guilds
+from logs import current_command
+from metrics import Metrics
+from outbound import OutboundScheduler
+from render import RenderScheduler
+from tracing import span
 
-def save_state(func):
+logger = logging.getLogger(__name__)
+
+
+def save_state(func=None, *, flush=False):
     """
-    Decorator to dump the state to disk after function is run
+    Decorator to checkpoint the storage of the guild of the channel the function returns (its mutations were
+    already persisted as they happened, in the background) and re-render that channel.
+    The re-render is debounced in the background unless flush is True, in which case we wait for it.
+    Usable both as @save_state and @save_state(flush=True)
     """
+    if func is None:
+        return partial(save_state, flush=flush)
+
     @wraps(func)
     async def decorated(*args, **kwargs):
         channel = await func(*args, **kwargs)
-        state = GlobalState()
-        state.save_current_state()
         if channel is not None:
-            await update_channel(channel)
+            state = Guilds().for_channel(channel)
+            with span("save_state", flush=flush):
+                start = time.perf_counter()
+                # Mutations were already persisted as they happened
+                state.storage.checkpoint()
+                Metrics().observe("lotus_save_seconds", time.perf_counter() - start, what="checkpoint")
+                state.mark_mutated(channel)
+                if flush:
+                    await RenderScheduler().flush(channel)
+                else:
+                    RenderScheduler().schedule(channel)
         return channel
 
     return decorated
 
 
+def instrument(func):
+    """
+    Decorator to record how long a command takes and whether it raised into metrics.Metrics and the log, and to
+    trace it as the span everything it does is traced under. Whatever is logged meanwhile is tagged with it.
+    Goes right under bot.command() so the time includes saving and everything else the command does. The checks
+    (has_role) run before the callback and arent part of it - on_command_error counts the commands they reject
+    """
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        ctx = args[0]
+        token = current_command.set((func.__name__, ctx.message.channel.name, ctx.message.author.id))
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            with span(
+                f"command {func.__name__}", "command",
+                channel=ctx.message.channel.name, user=ctx.message.author.id, content=ctx.message.content,
+            ):
+                result = await func(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            took = time.perf_counter() - start
+            Metrics().observe("lotus_command_seconds", took, command=func.__name__)
+            Metrics().inc("lotus_commands_total", command=func.__name__, outcome=outcome)
+            logger.info(f"Command |{func.__name__}| {outcome}", extra={"latency_ms": round(took * 1000, 1)})
+            current_command.reset(token)
+    return wrapper
+
+
 def enforce_channels(*allowed_channels):
     """
     Decorator to enforce that we are in a zone channel
@@ -28,16 +82,17 @@ def enforce_channels(*allowed_channels):
         async def wrapper(*args, **kwargs):
             ctx = args[0]
             if ctx.message.channel.name not in allowed_channels:
-                user_dm = await get_user_dm(ctx.message.author)
-                await user_dm.send(
+                Feedback().notify(
+                    ctx.message.author,
                     (
                         f"You sent `{ctx.message.content}` in {ctx.message.channel.mention}\n"
                         "That command is not allowed in that channel.\n"
                         f"You can retry in these channels: {allowed_channels}"
                     )
                 )
-                await ctx.message.delete()
+                OutboundScheduler().delete(ctx.message)
                 return
             return await func(*args, **kwargs)
         return wrapper
     return decorator
+
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+from globals import SingletonMetaclass
+from metrics import Metrics
+from outbound import OutboundScheduler
+from settings import (
+    DM_CHANNEL_CACHE_SIZE, DM_FANOUT_CONCURRENCY, FEEDBACK_MAX_DMS_PER_MINUTE, FEEDBACK_MAX_NOTICES,
+    FEEDBACK_WINDOW_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+
+class DirectMessages(metaclass=SingletonMetaclass):
+    """
+    DM channels cached by user id and fan-out of notifications to many users at once.
+
+    discord.py only keeps the last 128 private channels around, so with more players than that every DM would
+    start with a create_dm round-trip. Here the channels are kept in an LRU of DM_CHANNEL_CACHE_SIZE instead,
+    and concurrent lookups for the same user share a single create_dm.
+    """
+
+    def __init__(self):
+        # user id -> DMChannel, least recently used first
+        self._channels = OrderedDict()
+        # user id -> future of a create_dm that is already in flight
+        self._creating = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def channel(self, user):
+        dm_channel = self._channels.get(user.id)
+        if dm_channel is not None:
+            self.hits += 1
+            self._channels.move_to_end(user.id)
+            return dm_channel
+
+        dm_channel = user.dm_channel
+        if dm_channel is None:
+            self.misses += 1
+            creating = self._creating.get(user.id)
+            if creating is None:
+                creating = self._creating[user.id] = asyncio.ensure_future(user.create_dm())
+                creating.add_done_callback(lambda _: self._creating.pop(user.id, None))
+                creating.add_done_callback(_count_create_dm)
+            dm_channel = await asyncio.shield(creating)
+        else:
+            self.hits += 1
+
+        self._channels[user.id] = dm_channel
+        if len(self._channels) > DM_CHANNEL_CACHE_SIZE:
+            self._channels.popitem(last=False)
+        return dm_channel
+
+    def send(self, user, text):
+        """
+        DM the user in the background and return the task doing it
+        """
+        return asyncio.ensure_future(self._send(user, text))
+
+    def fan_out(self, notifications):
+        """
+        Send every (user, text) notification in the background and return the task doing it.
+        Notifications for the same user are merged into a single DM. They go out behind the DMs commands send.
+        """
+        merged = OrderedDict()
+        for user, text in notifications:
+            if user.id in merged:
+                merged[user.id][1].append(text)
+            else:
+                merged[user.id] = (user, [text])
+        return asyncio.ensure_future(self._send_all(list(merged.values())))
+
+    async def _send_all(self, merged):
+        semaphore = asyncio.Semaphore(DM_FANOUT_CONCURRENCY)
+
+        async def send(user, texts):
+            async with semaphore:
+                return await self._send(user, "\n".join(texts), fan_out=True)
+
+        results = await asyncio.gather(*[send(user, texts) for user, texts in merged])
+        logger.info(f"Sent |{sum(results)}| of |{len(merged)}| DMs")
+        return results
+
+    async def _send(self, user, text, fan_out=False):
+        try:
+            dm_channel = await self.channel(user)
+            if fan_out:
+                await OutboundScheduler().fan_out_dm(dm_channel, text)
+            else:
+                await OutboundScheduler().dm(dm_channel, text)
+        except Exception:
+            logger.exception(f"Failed to DM |{user}|")
+            return False
+        return True
+
+    def stats(self):
+        return {"cached": len(self._channels), "hits": self.hits, "misses": self.misses}
+
+
+class Feedback(metaclass=SingletonMetaclass):
+    """
+    Error notices for rejected commands, sent as one DM per user per FEEDBACK_WINDOW_SECONDS.
+
+    Notices for a user are buffered and go out together when the window closes, duplicates are dropped, and at
+    most FEEDBACK_MAX_NOTICES are kept. A user gets at most FEEDBACK_MAX_DMS_PER_MINUTE of these DMs, anything
+    past that keeps buffering until the minute is up.
+    """
+
+    def __init__(self):
+        # user id -> (user, notices waiting to be sent)
+        self._pending = {}
+        # user id -> task sending that users pending notices
+        self._tasks = {}
+        # user id -> times of the DMs sent in the last minute
+        self._sent = {}
+        self.notices = 0
+        self.dms = 0
+        self.duplicates = 0
+        self.dropped = 0
+
+    def notify(self, user, text):
+        self.notices += 1
+        pending = self._pending.get(user.id)
+        if pending is None:
+            pending = self._pending[user.id] = (user, [])
+        notices = pending[1]
+        if text in notices:
+            self.duplicates += 1
+            return
+        if len(notices) >= FEEDBACK_MAX_NOTICES:
+            self.dropped += 1
+            return
+        notices.append(text)
+        if user.id not in self._tasks:
+            self._tasks[user.id] = asyncio.ensure_future(self._send_later(user.id))
+
+    async def _send_later(self, user_id):
+        await asyncio.sleep(FEEDBACK_WINDOW_SECONDS)
+        sent = self._sent.setdefault(user_id, deque())
+        now = time.monotonic()
+        while sent and now - sent[0] >= 60:
+            sent.popleft()
+        if len(sent) >= FEEDBACK_MAX_DMS_PER_MINUTE:
+            await asyncio.sleep(60 - (now - sent[0]))
+            sent.popleft()
+
+        # Anything noticed from here on goes into the next DM
+        del self._tasks[user_id]
+        user, notices = self._pending.pop(user_id)
+        sent.append(time.monotonic())
+        self.dms += 1
+        try:
+            dm_channel = await DirectMessages().channel(user)
+            await OutboundScheduler().dm(dm_channel, "\n\n".join(notices))
+        except Exception:
+            logger.exception(f"Failed to send |{len(notices)}| feedback notices to |{user}|")
+
+    def stats(self):
+        return {"notices": self.notices, "dms": self.dms, "duplicates": self.duplicates, "dropped": self.dropped}
+
+
+def _count_create_dm(future):
+    # Doesnt go through OutboundScheduler, count it the same way
+    outcome = "error" if future.cancelled() or future.exception() is not None else "ok"
+    Metrics().inc("lotus_discord_requests_total", kind="create_dm", outcome=outcome)
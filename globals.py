@@ -1,43 +1,207 @@
+import asyncio
+import io
 import json
 import logging
-from dataclasses import asdict, dataclass, field, fields
+import os
+import threading
+import time
+from dataclasses import dataclass, field
 from datetime import datetime
 from os import path
 
-import discord
-from dotmap import DotMap
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, guild state files just go unlocked there
+    fcntl = None
 
-from settings import NUM_OF_LAYERS, NUMBER_EMOJI_MAPPING, SAVE_FILENAME, ZONES
+from history import PickHistory
+from settings import (
+    GUILD_STATE_DIR, JOURNAL_FILENAME, LOTUS_WINDOW_END_DELTA, LOTUS_WINDOW_START_DELTA, NUM_OF_LAYERS,
+    NUMBER_EMOJI_MAPPING, PICKS_FILENAME, SAVE_FILENAME, SQLITE_FILENAME, STARTUP_BACKLOG_LIMIT, ZONES
+)
+from tracing import traced
 
 logger = logging.getLogger(__name__)
 
 
-ABSOLUTE_CURRENT_SAVE_FP = path.join(path.dirname(path.abspath(__file__)), SAVE_FILENAME)
+ABSOLUTE_BASE_FP = path.dirname(path.abspath(__file__))
+# Where the single save file lived before the state was split up by guild
+ABSOLUTE_CURRENT_SAVE_FP = path.join(ABSOLUTE_BASE_FP, SAVE_FILENAME)
+ABSOLUTE_GUILD_STATE_FP = path.join(ABSOLUTE_BASE_FP, GUILD_STATE_DIR)
+
+
+def guild_path(guild_id, filename):
+    """
+    Path of one of a guilds state files. Each guild gets a directory of its own, no guild means the base directory
+    """
+    if guild_id is None:
+        return path.join(ABSOLUTE_BASE_FP, filename)
+    guild_fp = path.join(ABSOLUTE_GUILD_STATE_FP, str(guild_id))
+    os.makedirs(guild_fp, exist_ok=True)
+    return path.join(guild_fp, filename)
 
 
-@dataclass
 class LotusSpot:
-    name: str
-    number: int
-    player: int
+    """
+    A single lotus spot. The player is stored as their discord id, None when the spot is free
+    """
+    __slots__ = ("name", "number", "player")
+
+    def __init__(self, name, number, player=None):
+        self.name = name
+        self.number = number
+        self.player = player
 
     def as_presentable(self):
-        data = {
-            k: v.title()
-            if isinstance(v, str) else v
-            for k, v in asdict(self).items()
-        }
-        return LotusSpot(**data)
+        return LotusSpot(name=self.name.title(), number=self.number, player=self.player)
 
     def disc_table_fmt(self):
         return (
             f"{NUMBER_EMOJI_MAPPING[self.number]} | "
-            f"**__{self.name}__** - {self.player.mention if self.player else 'FREE'}"
+            f"**__{self.name}__** - {f'<@{self.player}>' if self.player else 'FREE'}"
         )
 
     def disc_message_fmt(self):
         return f"{NUMBER_EMOJI_MAPPING[self.number]} - **__{self.name}__**"
 
+    @classmethod
+    def from_dict(cls, data):
+        return cls(name=data["name"], number=int(data["number"]), player=data["player"])
+
+    def encode(self, out):
+        out.append(
+            f'{{"name": {_encode_str(self.name)}, "number": {self.number}, "player": {_encode_id(self.player)}}}'
+        )
+
+
+class Layer:
+    """
+    A layer of a zone - its discord channel, the two messages we keep up to date in it and its spots.
+    channel/table_message/status_message hold discord objects once on_ready has fetched them and are saved by id
+    (the channel by name). version is bumped on every mutation, see utils.EmbedCache
+
+    Occupancy is indexed as it changes, so spot players must only be changed through assign():
+    free_bits has bit n set while spot n is free and player_spots maps player id -> set of their spot numbers
+    """
+    __slots__ = (
+        "channel_name", "channel", "table_message", "status_message", "timer", "version", "spots",
+        "free_bits", "player_spots",
+    )
+
+    def __init__(self, channel_name, spots, channel=None, table_message=None, status_message=None, timer=None, version=0):
+        self.channel_name = channel_name
+        # spot number -> LotusSpot
+        self.spots = spots
+        self.channel = channel
+        self.table_message = table_message
+        self.status_message = status_message
+        self.timer = timer
+        self.version = version
+        self.free_bits = 0
+        self.player_spots = {}
+        for number, spot in spots.items():
+            if spot.player is None:
+                self.free_bits |= 1 << number
+            else:
+                self.player_spots.setdefault(spot.player, set()).add(number)
+
+    def assign(self, spot_number, player):
+        """
+        Set the player of a spot (None to free it) and keep the occupancy index in step
+        """
+        spot = self.spots[spot_number]
+        if spot.player is not None:
+            player_spots = self.player_spots[spot.player]
+            player_spots.discard(spot_number)
+            if not player_spots:
+                del self.player_spots[spot.player]
+        spot.player = player
+        if player is None:
+            self.free_bits |= 1 << spot_number
+        else:
+            self.free_bits &= ~(1 << spot_number)
+            self.player_spots.setdefault(player, set()).add(spot_number)
+
+    def free_count(self):
+        return bin(self.free_bits).count("1")
+
+    def free_spot_numbers(self):
+        bits = self.free_bits
+        numbers = []
+        while bits:
+            lowest = bits & -bits
+            numbers.append(lowest.bit_length() - 1)
+            bits ^= lowest
+        return numbers
+
+    def spots_of(self, player):
+        return sorted(self.player_spots.get(player, ()))
+
+    @classmethod
+    def fresh(cls, channel_name, spots_info):
+        return cls(
+            channel_name=channel_name,
+            spots={spot["number"]: LotusSpot(name=spot["name"], number=spot["number"]) for spot in spots_info},
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            channel_name=data["channel_name"],
+            spots={int(number): LotusSpot.from_dict(spot) for number, spot in data["spots"].items()},
+            table_message=data["table_message"],
+            status_message=data["status_message"],
+            timer=data["timer"],
+            # Saves from before layers carried a version dont have one
+            version=data.get("version", 0),
+        )
+
+    def encode(self, out):
+        out.append(
+            f'{{"channel": {_encode_str(self.channel_name)}, "channel_name": {_encode_str(self.channel_name)}, '
+            f'"table_message": {_encode_id(self.table_message)}, "status_message": {_encode_id(self.status_message)}, '
+            f'"timer": {_encode_datetime(self.timer)}, "version": {self.version}, "spots": {{'
+        )
+        first = True
+        for number, spot in self.spots.items():
+            if not first:
+                out.append(", ")
+            first = False
+            out.append(f'"{number}": ')
+            spot.encode(out)
+        out.append("}}")
+
+
+class Zone:
+    __slots__ = ("name", "layers")
+
+    def __init__(self, name, layers=None):
+        self.name = name
+        # layer number -> Layer
+        self.layers = layers if layers is not None else {}
+
+    @classmethod
+    def from_dict(cls, name, data):
+        return cls(name=name, layers={int(number): Layer.from_dict(layer) for number, layer in data["layers"].items()})
+
+    def encode(self, out):
+        out.append('{"layers": {')
+        first = True
+        for number, layer in self.layers.items():
+            if not first:
+                out.append(", ")
+            first = False
+            out.append(f'"{number}": ')
+            layer.encode(out)
+        out.append("}}")
+
+
+class SignupError(ValueError):
+    """
+    A signin/signout that cant go through. The message is meant for the user
+    """
+
 
 class SingletonMetaclass(type):
     _instances = {}
@@ -48,12 +212,111 @@ class SingletonMetaclass(type):
         return cls._instances[cls]
 
 
+class Guilds(metaclass=SingletonMetaclass):
+    """
+    The GlobalState of every guild, by guild id.
+    A guilds state is created and loaded from its storage the first time it is asked for, fresh if it has none.
+    """
+
+    def __init__(self):
+        self._states = {}
+        # guild id -> the open lock file that keeps other processes off its state
+        self._locks = {}
+        # guild state -> its storage backend, see storage.get_storage. Has to be set before the first guild loads
+        self.storage_factory = None
+
+    def get(self, guild_id):
+        global_state = self._states.get(guild_id)
+        if global_state is None:
+            global_state = self._states[guild_id] = self._load(guild_id)
+        return global_state
+
+    def for_channel(self, channel):
+        return self.get(channel.guild.id)
+
+    def __iter__(self):
+        return iter(list(self._states.values()))
+
+    def __len__(self):
+        return len(self._states)
+
+    def close(self):
+        """
+        Persist every guild right now and let go of their state files, the event loop may already be gone
+        """
+        for global_state in self:
+            if global_state.storage is not None:
+                try:
+                    global_state.storage.close(global_state)
+                except Exception:
+                    logger.exception(f"Failed to close the storage of guild |{global_state.guild_id}|")
+            if global_state.history is not None:
+                global_state.history.close()
+        for lock_file in self._locks.values():
+            lock_file.close()
+        self._locks = {}
+
+    def _load(self, guild_id):
+        start = time.perf_counter()
+        self._adopt_legacy_files(guild_id)
+        self._lock(guild_id)
+        global_state = GlobalState()
+        global_state.guild_id = guild_id
+        global_state.save_fp = guild_path(guild_id, SAVE_FILENAME)
+        if self.storage_factory is None:
+            raise RuntimeError("Guilds().storage_factory has to be set before loading a guild")
+        global_state.storage = self.storage_factory(global_state)
+        global_state.history = PickHistory(guild_path(guild_id, PICKS_FILENAME), global_state.storage.submit)
+        global_state.history.load()
+        global_state.load_current_saved_state()
+        if not global_state.state:
+            logger.info(f"No saved state for guild |{guild_id}| - starting fresh")
+            global_state.fresh_init()
+        logger.info(f"Loaded guild |{guild_id}| in |{(time.perf_counter() - start) * 1000:.1f}|ms")
+        return global_state
+
+    def _lock(self, guild_id):
+        """
+        Take an exclusive lock on the guilds state files for as long as this process lives, so that two processes
+        (e.g. two shards, see supervisor.py) can never write the same guild
+        """
+        if guild_id is None or fcntl is None:
+            return
+        lock_file = open(guild_path(guild_id, ".lock"), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise RuntimeError(f"The state of guild |{guild_id}| is already held by another process")
+        self._locks[guild_id] = lock_file
+
+    def _adopt_legacy_files(self, guild_id):
+        """
+        State files from before the split by guild are moved over to the first guild that boots without any
+        """
+        if guild_id is None or path.exists(path.join(ABSOLUTE_GUILD_STATE_FP, str(guild_id))):
+            return
+        legacy_fps = [
+            path.join(ABSOLUTE_BASE_FP, filename)
+            for base_filename in (SAVE_FILENAME, JOURNAL_FILENAME, SQLITE_FILENAME)
+            for filename in (base_filename, f"{base_filename}.compacting", f"{base_filename}-wal", f"{base_filename}-shm")
+        ]
+        for legacy_fp in legacy_fps:
+            if not path.exists(legacy_fp):
+                continue
+            try:
+                os.replace(legacy_fp, guild_path(guild_id, path.basename(legacy_fp)))
+            except FileNotFoundError:
+                # Another shard got to it first
+                continue
+            logger.info(f"Moved |{legacy_fp}| over to guild |{guild_id}|")
+
+
 @dataclass
-class GlobalState(metaclass=SingletonMetaclass):
+class GlobalState:
     """
-    Class that holds all the global state variables used by the bot.
-    Though there arent any explcit static methods/variables, the metaclass enforces the singleton pattern.
-    Any instantiation of this class with return the same instance of this class.
+    Class that holds all the state variables of a single guild.
+    Every guild the bot is in gets its own instance, get them through Guilds.
 
     ! NOT THREAD SAFE !
     """
@@ -63,116 +326,435 @@ class GlobalState(metaclass=SingletonMetaclass):
 
     """Attributes that shouldnt be serialized/saved"""
     # Set to True in the on_ready() callback once all messages/channels have been properly deserialized/inited
+    #   through set_initialized(), which releases everyone in wait_until_initialized()
     initialized = False
+    # Set through set_failed() when on_ready couldnt start the guild up, which releases everyone in
+    #   wait_until_initialized() too. Cleared by start_over() before trying again
+    failed = False
+    _ready = None
+    # How many callers are waiting on initialization right now, and how long the released ones waited
+    backlog = 0
+    backlog_released = 0
+    backlog_wait_total = 0.0
+    backlog_wait_max = 0.0
     # Reference to the discord info channel for message deleting
     info_channel = None
     boot_time = None
+    # The guild this is the state of, and where its json save file lives
+    guild_id = None
+    save_fp = ABSOLUTE_CURRENT_SAVE_FP
+    # storage backend (see storage.py) that loads the state and persists every mutation. Every state Guilds hands
+    #   out has one, None is only for states built by hand (e.g. the benchmarks)
+    storage = None
+    # Every pick the guild reported, see history.PickHistory. None predicts nothing
+    history = None
+
+    async def wait_until_initialized(self):
+        """
+        Wait for on_ready to finish. Waiters are all released the moment it does, in the order they started waiting.
+        Returns False straight away, without waiting, if STARTUP_BACKLOG_LIMIT callers are already waiting.
+        Check failed afterwards, startup may not have gone through
+        """
+        if self.initialized or self.failed:
+            return True
+        if self.backlog >= STARTUP_BACKLOG_LIMIT:
+            return False
+        self.backlog += 1
+        start = time.perf_counter()
+        try:
+            await self._ready_event().wait()
+        finally:
+            self.backlog -= 1
+        waited = time.perf_counter() - start
+        self.backlog_released += 1
+        self.backlog_wait_total += waited
+        self.backlog_wait_max = max(self.backlog_wait_max, waited)
+        return True
+
+    def set_initialized(self):
+        if self.backlog:
+            logger.info(f"Releasing |{self.backlog}| messages that arrived during startup")
+        self.initialized = True
+        self._ready_event().set()
+
+    def set_failed(self):
+        self.failed = True
+        self._ready_event().set()
+
+    def start_over(self):
+        """
+        Forget a failed startup before trying again, callers wait in wait_until_initialized() again meanwhile
+        """
+        self.failed = False
+        self._ready = None
+
+    def _ready_event(self):
+        # Created on first use so it belongs to the running event loop
+        if self._ready is None:
+            self._ready = asyncio.Event()
+        return self._ready
 
     def fresh_init(self):
         """
         self.state
         {
-            'Eastern-Plaguelands': {
-                'layers': {
-                    1: {
-                        'channel': None,
-                        'table_message': None,
-                        'status_message': None,
-                        'timer': None,
-                        'spots': {
-                            1: <__main__.LotusSpot at 0x7f165999c190>,
-                            2: <__main__.LotusSpot at 0x7f165999c1c0>,
-                        }
-                    },
-                    2: {
-                        'channel': None,
-                        'table_message': None,
-                        'status_message': None,
-                        'timer': None,
-                        'spots': {
-                            1: <__main__.LotusSpot at 0x7f165999c370>,
-                            2: <__main__.LotusSpot at 0x7f165999c3a0>,
+            'Eastern-Plaguelands': Zone(
+                name='Eastern-Plaguelands',
+                layers={
+                    1: Layer(
+                        channel_name='epl-layer-1',
+                        channel=None,
+                        table_message=None,
+                        status_message=None,
+                        timer=None,
+                        version=0,
+                        spots={
+                            1: LotusSpot(name='Cauldron 1', number=1, player=None),
+                            2: LotusSpot(name='Cauldron 2', number=2, player=713874692129423361),
                         }
-                    }
+                    ),
+                    2: Layer(...),
                 }
-            }
+            )
         }
 
-        for zone_name, zone in GlobalState().state.items():
+        for zone_name, zone in Guilds().get(guild_id).state.items():
             for layer_number, layer in zone.layers.items():
                 channel = layer.channel
                 table_message = layer.table_message
                 for spot_number, spot in layer.spots.items():
                     pass
         """
-        state = DotMap(_dynamic=True)
-        for ZONE, ZONE_INFO in ZONES.items():
-            state[ZONE] = DotMap()
-            state[ZONE].layers = DotMap()
-
+        self.state = {}
+        self._channels_by_id = {}
+        self._channels_by_name = {}
+        self._player_layers = {}
+        for ZONE in ZONES:
+            self.state[ZONE] = Zone(ZONE)
             for layer in range(1, NUM_OF_LAYERS + 1):
-                state[ZONE].layers[layer].channel = None
-                state[ZONE].layers[layer].table_message = None
-                state[ZONE].layers[layer].status_message = None
-                state[ZONE].layers[layer].spots = DotMap()
-                state[ZONE].layers[layer].channel_name = ZONE_INFO["channel_format"].format(layer)
-                state[ZONE].layers[layer].timer = None
-                for spot in ZONE_INFO["spots"]:
-                    spot_number = spot["number"]
-                    spot_name = spot["name"]
-                    print(type(spot_number))
-                    state[ZONE].layers[layer].spots[spot_number] = LotusSpot(
-                        name=spot_name,
-                        number=spot_number,
-                        player=None
-                    )
-        new_state = DotMap(state, _dynamic=False)
-        self.state = new_state
+                self.add_layer(ZONE, layer)
 
-    def _load_state(self, global_state):
-        state = DotMap(global_state["state"], _dynamic=False)
-        for zone in state:
-            for layer in state[zone].layers:
-                for spot in state[zone].layers[layer].spots:
-                    state[zone].layers[layer].spots[spot] = LotusSpot(**state[zone].layers[layer].spots[spot])
+    def add_layer(self, zone_name, layer_number):
+        """
+        Add a fresh layer to an existing zone and index its channel
+        """
+        zone_info = ZONES[zone_name]
+        layer = Layer.fresh(zone_info["channel_format"].format(layer_number), zone_info["spots"])
+        self.state[zone_name].layers[layer_number] = layer
+        self._index_layer(zone_name, layer_number, layer)
+        return layer
+
+    def __post_init__(self):
+        self.index_channels()
+        self.index_players()
 
-        return state
+    def _load_state(self, global_state):
+        return {zone_name: Zone.from_dict(zone_name, zone) for zone_name, zone in global_state["state"].items()}
 
+    @traced()
     def load_current_saved_state(self):
+        if self.storage is not None:
+            self.storage.load(self)
+        else:
+            self.load_snapshot()
+
+    def load_snapshot(self):
+        """
+        Load the json save file. Returns False if there isnt one
+        """
         try:
-            with open(ABSOLUTE_CURRENT_SAVE_FP, "r") as f:
+            with open(self.save_fp, "r") as f:
                 saved_state = json_load(f)
-                saved_state["state"] = self._load_state(saved_state)
-            self.__init__(**saved_state)
         except FileNotFoundError:
             logger.info("No save file found")
+            return False
+        self.load_saved_state(saved_state)
+        return True
+
+    def load_saved_state(self, saved_state):
+        """
+        Load a state in the same shape as the json save file
+        """
+        saved_state["state"] = self._load_state(saved_state)
+        self.__init__(**saved_state)
 
+    @traced()
+    def serialize(self):
+        """
+        Snapshot the state as a json string. Cheap enough to run on the event loop, the disk write isnt.
+        """
+        out = ['{"state": {']
+        first = True
+        for zone_name, zone in self.state.items():
+            if not first:
+                out.append(", ")
+            first = False
+            out.append(f"{_encode_str(zone_name)}: ")
+            zone.encode(out)
+        out.append("}}")
+        return "".join(out)
+
+    @traced()
     def save_current_state(self):
-        with open(ABSOLUTE_CURRENT_SAVE_FP, "w") as f:
-            json_dump(self, f)
+        """
+        Synchronously and atomically write the current state to disk.
+        Blocks whoever calls it - on the event loop use persistence.StateSaver instead.
+        """
+        atomic_write(self.save_fp, self.serialize())
 
     def get_state_for_channel(self, channel):
         """
-        returns the appropriate layer dict
-        {
-            'channel': None,
-            'table_message': None,
-            'status_message': None,
-            'timer': None,
-            'spots': {
-                1: <__main__.LotusSpot at 0x7f165999c190>,
-                2: <__main__.LotusSpot at 0x7f165999c1c0>,
-        }
+        returns (zone name, layer number, Layer) for the channel, which can be a discord channel or its name
         """
-        if isinstance(channel, discord.TextChannel):
-            channel_name = channel.name
-        else:
+        if isinstance(channel, str):
             channel_name = channel
+        else:
+            found = self._channels_by_id.get(channel.id)
+            if found is not None:
+                return found
+            channel_name = channel.name
+        found = self._channels_by_name.get(channel_name)
+        if found is None:
+            raise ValueError(f"|{channel_name}| channel state not found")
+        return found
+
+    def is_layer_channel(self, channel):
+        return channel.id in self._channels_by_id or channel.name in self._channels_by_name
+
+    def index_channels(self):
+        """
+        (Re)build the channel -> layer index. Discord channels are indexed by id once on_ready has populated them,
+            until then (and as a fallback) layers are found by channel name
+        """
+        self._channels_by_id = {}
+        self._channels_by_name = {}
         for zone_name, zone in self.state.items():
             for layer_number, layer_state in zone.layers.items():
-                if channel_name == layer_state.channel_name:
-                    return zone_name, layer_number, layer_state
-        raise ValueError(f"|{channel_name}| channel state not found")
+                self._index_layer(zone_name, layer_number, layer_state)
+
+    def set_layer_channel(self, layer_state, channel):
+        """
+        Attach the discord channel to the layer and index it by id
+        """
+        layer_state.channel = channel
+        found = self._channels_by_name[layer_state.channel_name]
+        self._channels_by_id[channel.id] = found
+
+    def index_players(self):
+        """
+        (Re)build the player id -> {(zone name, layer number)} index of every layer a player is signed into
+        """
+        self._player_layers = {}
+        for zone_name, zone in self.state.items():
+            for layer_number, layer_state in zone.layers.items():
+                for player in layer_state.player_spots:
+                    self._player_layers.setdefault(player, set()).add((zone_name, layer_number))
+
+    @traced()
+    def signups_for_player(self, player):
+        """
+        Every spot the player is signed into across all zones and layers
+        returns [(zone name, layer number, [LotusSpot, ...]), ...]
+        """
+        signups = []
+        for zone_name, layer_number in sorted(self._player_layers.get(player, ())):
+            layer_state = self.state[zone_name].layers[layer_number]
+            signups.append(
+                (zone_name, layer_number, [layer_state.spots[number] for number in layer_state.spots_of(player)])
+            )
+        return signups
+
+    def _index_layer(self, zone_name, layer_number, layer_state):
+        found = (zone_name, layer_number, layer_state)
+        self._channels_by_name[layer_state.channel_name] = found
+        channel_id = getattr(layer_state.channel, "id", None)
+        if channel_id is not None:
+            self._channels_by_id[channel_id] = found
+
+    @traced()
+    def claim_spots(self, zone_name, layer_number, spot_nums, player):
+        """
+        Validate the spot numbers (as typed by the user, or ints) and sign the player into all of them in one go.
+        Raises SignupError without touching anything if any of them cant be taken.
+        Returns the sorted spot numbers signed into
+        Atomic because nothing in here awaits - no other command can run between validating and assigning. Keep it
+            that way, and do the validation and the assignment of a command in a single call like this one
+        """
+        layer_state = self.state[zone_name].layers[layer_number]
+        if len(spot_nums) == 0:
+            raise SignupError(
+                "You need to give me atleast one lotus spot number\n"
+                f"You can choose from the following: {layer_state.free_spot_numbers()}"
+            )
+
+        valid_spot_nums = set()
+        for spot_num in spot_nums:
+            try:
+                spot_num = int(spot_num)
+            except ValueError:
+                raise SignupError(
+                    "Pretty sure at least one of those aint a valid number\n"
+                    f"You can choose from the following: {layer_state.free_spot_numbers()}"
+                )
+            if spot_num not in layer_state.spots:
+                raise SignupError(
+                    "Pretty sure atleast one of those aint a valid spot number\n"
+                    f"You can choose from the following: {layer_state.free_spot_numbers()}"
+                )
+            if layer_state.spots[spot_num].player is not None:
+                raise SignupError(
+                    "At least one of those spots is already taken\n"
+                    f"You can choose from the following: {layer_state.free_spot_numbers()}"
+                )
+            valid_spot_nums.add(spot_num)
+
+        valid_spot_nums = sorted(valid_spot_nums)
+        self.signin_spots(zone_name, layer_number, valid_spot_nums, player)
+        return valid_spot_nums
+
+    @traced()
+    def release_spots(self, zone_name, layer_number, spot_nums, player):
+        """
+        Validate the spot numbers (as typed by the user, or ints) and sign the player out of all of them in one go.
+        No spot numbers signs the player out of every spot they have on the layer.
+        Raises SignupError without touching anything if they arent signed into any of them.
+        Returns the sorted spot numbers signed out of
+        Atomic because nothing in here awaits, see claim_spots
+        """
+        layer_state = self.state[zone_name].layers[layer_number]
+        signedin_spot_nums = layer_state.spots_of(player)
+        if not signedin_spot_nums:
+            raise SignupError("You can't sign out of spots if you're not signed into any in the first place")
+        if len(spot_nums) == 0:
+            self.signout_spots(zone_name, layer_number, signedin_spot_nums)
+            return signedin_spot_nums
+
+        valid_spot_nums = set()
+        for spot_num in spot_nums:
+            try:
+                spot_num = int(spot_num)
+            except ValueError:
+                raise SignupError(
+                    "Pretty sure at least one of those aint a valid number\n"
+                    f"You can choose from the following: {signedin_spot_nums}"
+                )
+            if spot_num not in layer_state.spots:
+                raise SignupError(
+                    "Pretty sure atleast one of those aint a valid spot number\n"
+                    f"You can choose from the following: {signedin_spot_nums}"
+                )
+            if layer_state.spots[spot_num].player != player:
+                raise SignupError(
+                    "At least one of those spots is taken by someone else or you aint signed into it\n"
+                    f"You can choose from the following: {signedin_spot_nums}"
+                )
+            valid_spot_nums.add(spot_num)
+
+        valid_spot_nums = sorted(valid_spot_nums)
+        self.signout_spots(zone_name, layer_number, valid_spot_nums)
+        return valid_spot_nums
+
+    def signin_spots(self, zone_name, layer_number, spot_nums, player):
+        self._record({"op": "signin", "zone": zone_name, "layer": layer_number, "spots": list(spot_nums), "player": player})
+
+    def signout_spots(self, zone_name, layer_number, spot_nums):
+        self._record({"op": "signout", "zone": zone_name, "layer": layer_number, "spots": list(spot_nums)})
+
+    def clear_layer(self, zone_name, layer_number):
+        self._record({"op": "clear", "zone": zone_name, "layer": layer_number})
+
+    def set_timer(self, zone_name, layer_number, timer):
+        self._record({"op": "timer", "zone": zone_name, "layer": layer_number, "timer": timer})
+
+    def record_pick(self, zone_name, layer_number, spot_number, timer):
+        """
+        A lotus was picked at timer, from spot_number if anyone knows which one it was
+        """
+        self.set_timer(zone_name, layer_number, timer)
+        if self.history is not None:
+            self.history.record(zone_name, layer_number, spot_number, timer)
+
+    def lotus_window(self, zone_name, layer_number):
+        """
+        (opens, closes) datetimes of the layers next lotus window, None if it was never picked.
+            Predicted from the layers pick history once there is enough of it, LOTUS_WINDOW_*_DELTA until then
+        """
+        timer = self.state[zone_name].layers[layer_number].timer
+        if timer is None:
+            return None
+        predicted = self.history.window(zone_name, layer_number) if self.history is not None else None
+        start_delta, end_delta = predicted or (LOTUS_WINDOW_START_DELTA, LOTUS_WINDOW_END_DELTA)
+        return timer + start_delta, timer + end_delta
+
+    def _record(self, entry):
+        entry["ts"] = datetime.now()
+        self.apply(entry)
+        if self.storage is not None:
+            self.storage.record(entry)
+
+    def apply(self, entry):
+        """
+        Apply a single mutation. Every mutation sets absolute values, so applying one twice is harmless -
+            which is what makes replaying a journal on top of a newer snapshot safe.
+        """
+        # Journals written before the state was keyed by ints hold layer/spot numbers as strings
+        zone_name, layer_number = entry["zone"], int(entry["layer"])
+        layer_state = self.state[zone_name].layers[layer_number]
+        op = entry["op"]
+        if op == "timer":
+            layer_state.timer = entry["timer"]
+            return
+
+        players_before = set(layer_state.player_spots)
+        if op == "signin":
+            for spot_num in entry["spots"]:
+                layer_state.assign(int(spot_num), entry["player"])
+        elif op == "signout":
+            for spot_num in entry["spots"]:
+                layer_state.assign(int(spot_num), None)
+        elif op == "clear":
+            for spot_num in layer_state.spots:
+                layer_state.assign(spot_num, None)
+        else:
+            raise ValueError(f"|{op}| is not a known mutation")
+
+        if op == "signin":
+            self._player_layers.setdefault(entry["player"], set()).add((zone_name, layer_number))
+        for player in players_before.difference(layer_state.player_spots):
+            player_layers = self._player_layers[player]
+            player_layers.discard((zone_name, layer_number))
+            if not player_layers:
+                del self._player_layers[player]
+
+    def mark_mutated(self, channel):
+        """
+        Bump the mutation version of the layer behind the channel so its embeds get re-rendered
+        """
+        _, _, layer_state = self.get_state_for_channel(channel)
+        layer_state.version += 1
+
+
+"""
+Hand written encoders for the save file - they write straight from the slotted objects instead of building and
+    copying intermediate dicts first
+"""
+
+_encode_str = json.encoder.encode_basestring
+
+
+def _encode_id(obj):
+    """
+    Discord objects are saved by id, ids are saved as they are
+    """
+    if obj is None:
+        return "null"
+    return str(getattr(obj, "id", obj))
+
+
+def _encode_datetime(timestamp):
+    if timestamp is None:
+        return "null"
+    return f'"{timestamp.isoformat()}"'
 
 
 """
@@ -199,27 +781,45 @@ def json_load(fp):
     return json.load(fp, object_pairs_hook=json_custom_deserializer)
 
 
-def json_dump(obj, fp):
+def json_loads(s):
     """
-    Custom json.dump that automatically converts datetime objects to isoformat strings and converts
-        dataclasses to their dictionary representations
-    """
-    def json_custom_serializer(obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        if isinstance(obj, GlobalState):
-            # We do this rather than using asdict() as that tries to deepcopy the values returned
-            #   This fails spectacularly for the discord.Message object
-            return {field.name: getattr(obj, field.name) for field in fields(obj)}
-        if isinstance(obj, LotusSpot):
-            return {field.name: getattr(obj, field.name) for field in fields(obj)}
-        if isinstance(obj, discord.Message):
-            return obj.id
-        if isinstance(obj, discord.TextChannel):
-            return obj.name
-        if isinstance(obj, discord.Member):
-            return obj.id
-        if isinstance(obj, DotMap):
-            return obj.toDict()
+    Same as json_load but reads from a string
+    """
+    return json_load(io.StringIO(s))
+
 
+def json_dump(obj, fp):
+    """
+    Custom json.dump that automatically converts datetime objects to isoformat strings
+    """
     return json.dump(obj, default=json_custom_serializer, fp=fp)
+
+
+def json_dumps(obj):
+    """
+    Same as json_dump but returns a string
+    """
+    return json.dumps(obj, default=json_custom_serializer)
+
+
+def json_custom_serializer(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError(f"|{type(obj)}| is not json serializable")
+
+
+_write_lock = threading.Lock()
+
+
+def atomic_write(fp, data):
+    """
+    Write data to a temp file next to fp and rename it over fp, so a crash mid-write never leaves a
+        truncated save behind. Safe to call from worker threads.
+    """
+    tmp_fp = f"{fp}.tmp"
+    with _write_lock:
+        with open(tmp_fp, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fp, fp)
@@ -0,0 +1,150 @@
+import logging
+import time
+from datetime import timedelta
+
+import numpy
+
+from settings import PREDICTION_MIN_SAMPLES, PREDICTION_PERCENTILES, PREDICTION_RESPAWN_RANGE
+
+logger = logging.getLogger(__name__)
+
+
+RESPAWN_MIN = PREDICTION_RESPAWN_RANGE[0].total_seconds()
+RESPAWN_MAX = PREDICTION_RESPAWN_RANGE[1].total_seconds()
+
+
+class PickHistory:
+    """
+    Every lotus pick of a guild and the respawn times they add up to.
+
+    Picks are kept by (zone name, layer number, spot number) as sorted numpy arrays of epoch seconds, spot None
+    holding every pick of the layer. Each key also keeps its respawn times - the time between two picks in a row -
+    sorted, so a new pick only inserts its own respawn times and a predicted window is one numpy.percentile over them.
+    The picks file is append-only, one "zone<TAB>layer<TAB>spot<TAB>timestamp" line per pick (spot 0 if unknown).
+    It is written by submit(func, *args), which runs func on the thread that writes the guilds storage.
+    """
+
+    def __init__(self, fp, submit):
+        self.fp = fp
+        self._submit = submit
+        self._file = None
+        # key -> sorted float64 array of pick timestamps, and of respawn seconds
+        self._picks = {}
+        self._respawns = {}
+
+    def load(self):
+        start = time.perf_counter()
+        timestamps = {}
+        try:
+            with open(self.fp, "r") as f:
+                for line_number, line in enumerate(f, start=1):
+                    try:
+                        zone_name, layer_number, spot_number, timestamp = line.rstrip("\n").split("\t")
+                        timestamp = float(timestamp)
+                        layer_number, spot_number = int(layer_number), int(spot_number)
+                    except ValueError:
+                        logger.warning(f"Skipping unreadable line |{line_number}| of |{self.fp}|")
+                        continue
+                    for key in self._keys(zone_name, layer_number, spot_number):
+                        timestamps.setdefault(key, []).append(timestamp)
+        except FileNotFoundError:
+            return
+
+        for key, key_timestamps in timestamps.items():
+            self._picks[key], self._respawns[key] = _build(key_timestamps)
+        logger.info(
+            f"Loaded |{sum(len(picks) for picks in timestamps.values())}| picks from |{self.fp}| in "
+            f"|{(time.perf_counter() - start) * 1000:.1f}|ms"
+        )
+
+    def record(self, zone_name, layer_number, spot_number, timer):
+        """
+        Add a pick made at timer, spot_number is None when nobody knows which spot it was
+        """
+        timestamp = timer.timestamp()
+        line = f"{zone_name}\t{layer_number}\t{spot_number or 0}\t{timestamp}\n"
+        self._submit(self._write, line).add_done_callback(_log_failure)
+        for key in self._keys(zone_name, layer_number, spot_number):
+            self._insert(key, timestamp)
+
+    def window(self, zone_name, layer_number, spot_number=None):
+        """
+        (start, end) timedeltas after a pick that the next lotus is expected to spawn between,
+            None until the key has PREDICTION_MIN_SAMPLES respawn times
+        """
+        respawns = self._respawns.get((zone_name, layer_number, spot_number))
+        if respawns is None or len(respawns) < PREDICTION_MIN_SAMPLES:
+            return None
+        low, high = numpy.percentile(respawns, PREDICTION_PERCENTILES)
+        return timedelta(seconds=float(low)), timedelta(seconds=float(high))
+
+    def samples(self, zone_name, layer_number, spot_number=None):
+        return len(self._respawns.get((zone_name, layer_number, spot_number), ()))
+
+    def close(self):
+        """
+        Close the picks file, once every write submitted has gone through
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def _keys(zone_name, layer_number, spot_number):
+        yield zone_name, layer_number, None
+        if spot_number:
+            yield zone_name, layer_number, spot_number
+
+    def _write(self, line):
+        if self._file is None:
+            self._file = open(self.fp, "a")
+        self._file.write(line)
+        self._file.flush()
+
+    def _insert(self, key, timestamp):
+        picks = self._picks.get(key, _EMPTY)
+        respawns = self._respawns.get(key, _EMPTY)
+        # Picks reported late land in the middle, splitting the respawn time of the picks around them
+        index = int(numpy.searchsorted(picks, timestamp, side="right"))
+        before = picks[index - 1] if index > 0 else None
+        after = picks[index] if index < len(picks) else None
+        if before is not None and after is not None:
+            respawns = _discard(respawns, after - before)
+        self._picks[key] = numpy.insert(picks, index, timestamp)
+        if before is not None:
+            respawns = _add(respawns, timestamp - before)
+        if after is not None:
+            respawns = _add(respawns, after - timestamp)
+        self._respawns[key] = respawns
+
+
+_EMPTY = numpy.empty(0, dtype=numpy.float64)
+
+
+def _build(timestamps):
+    """
+    (sorted picks, sorted respawn times) from a keys pick timestamps in any order
+    """
+    picks = numpy.sort(numpy.array(timestamps, dtype=numpy.float64))
+    respawns = numpy.diff(picks)
+    respawns = numpy.sort(respawns[(respawns >= RESPAWN_MIN) & (respawns <= RESPAWN_MAX)])
+    return picks, respawns
+
+
+def _add(respawns, respawn):
+    if RESPAWN_MIN <= respawn <= RESPAWN_MAX:
+        return numpy.insert(respawns, int(numpy.searchsorted(respawns, respawn)), respawn)
+    return respawns
+
+
+def _discard(respawns, respawn):
+    if RESPAWN_MIN <= respawn <= RESPAWN_MAX:
+        index = int(numpy.searchsorted(respawns, respawn))
+        if index < len(respawns) and respawns[index] == respawn:
+            return numpy.delete(respawns, index)
+    return respawns
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.error("Failed to write a pick", exc_info=future.exception())
@@ -0,0 +1,125 @@
+"""
+Logging that stays off the event loop.
+
+Records go through a queue to a thread that formats and writes them, so a burst of warnings doesnt make the
+gateway wait for stdout. Every logging call (file and line) may log at most LOG_RATE_LIMIT warnings and errors per
+window, the first record of the next window says how many were dropped.
+
+Records logged while a command is handled carry its command, channel and user, see decorators.instrument.
+That includes the OutboundScheduler requests it queued, they run in its context.
+"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+
+from settings import LOG_JSON, LOG_RATE_LIMIT
+
+TEXT_FORMAT = "%(levelname)s:%(name)s:[%(asctime)s] %(message)s"
+DATE_FMT = "%Y-%m-%d %H:%M:%S"
+# Fields a record may carry on top of the message, either from the command context or passed in extra
+FIELDS = ("command", "channel", "user", "latency_ms", "suppressed")
+
+# (command, channel name, user id) of the command handled in this context, None outside of commands
+current_command = contextvars.ContextVar("command", default=None)
+
+
+class CommandContext(logging.Filter):
+    """
+    Puts the command the record was logged in on it. Runs as the record is logged, the writer thread doesnt know
+    """
+
+    def filter(self, record):
+        command = current_command.get()
+        if command is not None and getattr(record, "command", None) is None:
+            record.command, record.channel, record.user = command
+        return True
+
+
+class RateLimit(logging.Filter):
+    def __init__(self, records, seconds):
+        super().__init__()
+        self.records = records
+        self.seconds = seconds
+        # (file, line) -> [window start, records let through, records dropped]
+        self._windows = {}
+        # Saves and the profiler log from threads of their own
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or record.created - window[0] >= self.seconds:
+                self._windows[key] = [record.created, 1, 0]
+                if window is not None and window[2]:
+                    record.suppressed = window[2]
+                return True
+            if window[1] < self.records:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The record stays in this process, so the traceback is left for the writer thread to format
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super().format(record)
+        fields = [f"{field} {getattr(record, field)}" for field in FIELDS if getattr(record, field, None) is not None]
+        if fields:
+            text = f"{text} |{'|'.join(fields)}|"
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    {"t": 1717171717.123, "level": "WARNING", "logger": "main", "msg": "...", "command": "signin",
+        "channel": "epl-layer-1", "user": 123, "latency_ms": 12.3, "exc": "Traceback ..."}
+    """
+
+    def format(self, record):
+        entry = {
+            "t": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(level=logging.INFO, stream=sys.stdout):
+    """
+    Send everything logged to the queue and start the writer thread. Returns the listener, stop() it on the way
+    out so whatever is still queued gets written
+    """
+    writer = logging.StreamHandler(stream)
+    writer.setFormatter(JsonFormatter() if LOG_JSON else TextFormatter(TEXT_FORMAT, DATE_FMT))
+    records = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(RateLimit(*LOG_RATE_LIMIT))
+    handler.addFilter(CommandContext())
+    logging.basicConfig(level=level, handlers=[handler])
+    listener = logging.handlers.QueueListener(records, writer)
+    listener.start()
+    return listener
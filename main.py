@@ -1,32 +1,119 @@
 import asyncio
 import logging
 import sys
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
+from os import path
 
 import discord
 from discord.ext.commands import Bot, CommandNotFound, MissingRole, has_role
 
-from decorators import save_state, enforce_channels
-from globals import GlobalState
-from settings import ADMIN_ROLE_ID, AUTHORIZED_CHANNELS, DISCORD_TOKEN, PREFIX, ZONE_CHANNELS, LOTUS_TIMER_CHANNEL, ADMIN_CHANNEL
-from utils import get_user_dm, update_channel
+from decorators import enforce_channels, instrument, save_state
+from dms import DirectMessages, Feedback
+from globals import GlobalState, Guilds, SignupError
+from logs import setup_logging
+from metrics import Metrics
+from outbound import OutboundScheduler
+from recorder import EventRecorder
+from settings import (
+    ADMIN_ROLE_ID, DISCORD_TOKEN, PREFIX, ZONE_CHANNELS, LOTUS_TIMER_CHANNEL, ADMIN_CHANNEL, STARTUP_CONCURRENCY,
+    GUILD_STARTUP_RETRY_SECONDS,
+    NUMBER_REACTION_MAPPING, REACTION_SIGNUPS, SHARD_HEARTBEAT_SECONDS, METRICS_PORT, PROFILER_MAX_SECONDS
+)
+from storage import get_storage
+from supervisor import shard_from_env, write_shard_health
+from timers import LotusTimers
+from tracing import ABSOLUTE_BASE_FP, profiler, tracer
+from utils import (
+    EmbedCache, ensure_spot_reactions, gather_bounded, reset_spot_reactions, unqualified_emoji, update_channel
+)
 
 logger = logging.getLogger(__name__)
 
-bot = Bot(command_prefix=PREFIX)
+# Reaction emoji, see unqualified_emoji -> spot number
+REACTION_NUMBER_MAPPING = {unqualified_emoji(emoji): number for number, emoji in NUMBER_REACTION_MAPPING.items()}
+
+SHARD_ID, SHARD_COUNT = shard_from_env()
+if SHARD_ID is not None:
+    tracer.fp = f"{tracer.fp}.{SHARD_ID}"
+
+bot = Bot(command_prefix=PREFIX, shard_id=SHARD_ID, shard_count=SHARD_COUNT)
 bot.remove_command("help")
 
+Metrics().gauge("lotus_startup_backlog", lambda: sum(state.backlog for state in Guilds()))
+Metrics().gauge(
+    "lotus_outbound_queue_depth",
+    lambda: {priority: stats["depth"] for priority, stats in OutboundScheduler().stats().items()},
+    label="priority",
+)
+
 
 @bot.event
 async def on_ready():
     logger.info(f"Successfully logged in as {bot.user.name}")
-    global_state = GlobalState()
 
     servers = bot.guilds
     logger.info("Our servers are: {}".format([server.name for server in servers]))
-    assert len(servers) == 1
-    server = servers[0]
-    logger.info(f"{server.name} is bae")
+    if SHARD_ID is not None:
+        _start_heartbeat()
+    if METRICS_PORT is not None:
+        try:
+            await Metrics().start_server(METRICS_PORT + (SHARD_ID or 0))
+        except OSError:
+            logger.exception("Failed to start serving metrics")
+    # Every guild starts up on its own, one that is slow or broken doesnt hold up the rest
+    await gather_bounded([_start_guild(server) for server in servers], STARTUP_CONCURRENCY)
+
+
+@bot.event
+async def on_guild_join(server):
+    logger.info(f"Joined {server.name}")
+    await _start_guild(server)
+
+
+# guild id -> task waiting to retry the startup of a guild that failed to start up
+_startup_retries = {}
+
+
+async def _start_guild(server, attempt=0):
+    retry = _startup_retries.pop(server.id, None)
+    if retry is not None and retry is not asyncio.current_task():
+        # Starting up now anyway
+        retry.cancel()
+    try:
+        global_state = Guilds().get(server.id)
+    except Exception:
+        logger.exception(f"Failed to load the state of {server.name}")
+        return
+    try:
+        if global_state.initialized:
+            # A gateway reconnect - the state in memory is still good
+            await _revalidate(server, global_state)
+            return
+        if global_state.failed:
+            global_state.start_over()
+        if await _init_guild(server, global_state):
+            return
+    except Exception:
+        logger.exception(f"Failed to start up {server.name}")
+    if global_state.initialized:
+        return
+
+    # Rather than have its commands wait for a startup that isnt coming, turn them away until a retry goes through
+    delay = min(GUILD_STARTUP_RETRY_SECONDS[0] * 2 ** attempt, GUILD_STARTUP_RETRY_SECONDS[1])
+    logger.error(f"Startup of {server.name} failed - turning its commands away and retrying in |{delay}|s")
+    global_state.set_failed()
+    _startup_retries[server.id] = asyncio.ensure_future(_retry_guild(server, delay, attempt + 1))
+
+
+async def _retry_guild(server, delay, attempt):
+    await asyncio.sleep(delay)
+    await _start_guild(server, attempt)
+
+
+async def _init_guild(server, global_state):
+    phase_start = time.perf_counter()
+    timings = {}
 
     # Populate channels with discord objects
     discord_channels = {channel.name: channel for channel in server.channels}
@@ -34,59 +121,53 @@ async def on_ready():
         for layer_number, layer in zone.layers.items():
             channel = discord_channels.get(layer.channel_name, None)
             if channel is None:
-                logger.error(f"Couldn't find |{layer.channel_name}| channel. Choices were: |{discord_channels}|")
-                exit()
-            layer.channel = channel
+                logger.error(
+                    f"Couldn't find |{layer.channel_name}| channel in {server.name}. Choices were: |{discord_channels}|"
+                )
+                return False
+            global_state.set_layer_channel(layer, channel)
+    timings["channels"], phase_start = time.perf_counter() - phase_start, time.perf_counter()
+
+    layers = [layer for zone in global_state.state.values() for layer in zone.layers.values()]
 
     # Populate messages with discord objects
-    table_messages = [
-            layer.table_message
-            for zone in global_state.state.values()
-            for layer in zone.layers.values()
-    ]
-    status_messages = [
-            layer.status_message
-            for zone in global_state.state.values()
-            for layer in zone.layers.values()
-    ]
+    table_messages = [layer.table_message for layer in layers]
+    status_messages = [layer.status_message for layer in layers]
     if not all(table_messages) or not all(status_messages):
         # One or more messages have not been initialised
-        logger.warning("Messages werent initialised - Doing that now")
+        logger.warning(f"Messages werent initialised in {server.name} - Doing that now")
         # We assume that channels have been loaded above
-        for zone_name, zone in GlobalState().state.items():
-            for layer_number, layer in zone.layers.items():
-                channel = layer.channel
-                # Wipe channel
-                await channel.purge(limit=None)
-                layer.status_message = await channel.send("I'm bootin' baby!")
-                layer.table_message = await channel.send("I'm bootin' baby!")
+        await gather_bounded([_init_layer_messages(layer) for layer in layers], STARTUP_CONCURRENCY)
     else:
         # We assume that channels have been loaded above
-        for zone_name, zone in GlobalState().state.items():
-            for layer_number, layer in zone.layers.items():
-                try:
-                    layer.table_message = await layer.channel.fetch_message(layer.table_message)
-                    layer.status_message = await layer.channel.fetch_message(layer.status_message)
-                except discord.NotFound:
-                    logger.error(f"Could not find message {layer.table_message}")
-                    await layer.channel.send("Couldn't find my info message in here - Let Malzo know!")
-                    exit()
-
-    # Populate all the users
-    for zone_name, zone in GlobalState().state.items():
-        for layer_number, layer in zone.layers.items():
-            for spot_number, spot in layer.spots.items():
-                if spot.player is not None:
-                    discord_member = server.get_member(spot.player)
-                    if discord_member is None:
-                        logger.warning(f"Failed to find user with id |{spot.player}|")
-                    spot.player = discord_member
-
-    for zone_name, zone in GlobalState().state.items():
-        for layer_number, layer in zone.layers.items():
-            await update_channel(layer.channel)
-    global_state.initialized = True
-    global_state.save_current_state()
+        found = await gather_bounded([_fetch_layer_messages(layer) for layer in layers], STARTUP_CONCURRENCY)
+        if not all(found):
+            return False
+    timings["messages"], phase_start = time.perf_counter() - phase_start, time.perf_counter()
+
+    # Players are kept as ids - just make sure they're all still around
+    for layer in layers:
+        for spot_number, spot in layer.spots.items():
+            if spot.player is not None and server.get_member(spot.player) is None:
+                logger.warning(f"Failed to find user with id |{spot.player}| in {server.name}")
+    timings["members"], phase_start = time.perf_counter() - phase_start, time.perf_counter()
+
+    await gather_bounded([update_channel(layer.channel) for layer in layers], STARTUP_CONCURRENCY)
+    timings["render"], phase_start = time.perf_counter() - phase_start, time.perf_counter()
+
+    if REACTION_SIGNUPS:
+        await gather_bounded([ensure_spot_reactions(layer) for layer in layers], STARTUP_CONCURRENCY)
+        timings["reactions"] = time.perf_counter() - phase_start
+
+    global_state.set_initialized()
+    global_state.storage.save(global_state)
+    # Callouts of picks made before we went down
+    LotusTimers().rebuild(global_state)
+    logger.info(
+        f"Startup of |{len(layers)}| layers in {server.name} took: "
+        + ", ".join([f"{phase} |{duration * 1000:.1f}|ms" for phase, duration in timings.items()])
+    )
+    return True
 
     # chan = discord_channels["ony-calendar"]
     # msg = await chan.fetch_message(714483211119493121)
@@ -102,6 +183,91 @@ async def on_ready():
     #     print()
 
 
+async def _revalidate(server, global_state):
+    """
+    Fast path of guild startup for when it's already been initialised. Only refreshes discord objects that went stale
+        and only re-renders layers whose messages dont already show their current state.
+    """
+    start = time.perf_counter()
+    layers = [layer for zone in global_state.state.values() for layer in zone.layers.values()]
+
+    stale_layers = []
+    for layer in layers:
+        channel = server.get_channel(layer.channel.id)
+        if channel is None:
+            logger.error(f"|{layer.channel_name}| channel disappeared from {server.name} while we were disconnected")
+            return
+        if channel is not layer.channel:
+            global_state.set_layer_channel(layer, channel)
+            stale_layers.append(layer)
+    found = await gather_bounded([_fetch_layer_messages(layer) for layer in stale_layers], STARTUP_CONCURRENCY)
+    if not all(found):
+        return
+    if REACTION_SIGNUPS:
+        await gather_bounded([ensure_spot_reactions(layer) for layer in stale_layers], STARTUP_CONCURRENCY)
+
+    cache = EmbedCache()
+    outdated_layers = [
+        layer for layer in layers
+        if not cache.is_current(layer.status_message, layer.version)
+        or not cache.is_current(layer.table_message, layer.version)
+    ]
+    await gather_bounded([update_channel(layer.channel) for layer in outdated_layers], STARTUP_CONCURRENCY)
+    logger.info(
+        f"Reconnected to {server.name} - refetched |{len(stale_layers)}| stale layers and re-rendered "
+        f"|{len(outdated_layers)}| of |{len(layers)}| layers in |{(time.perf_counter() - start) * 1000:.1f}|ms"
+    )
+
+
+_heartbeat_task = None
+
+
+def _start_heartbeat():
+    global _heartbeat_task
+    if _heartbeat_task is None or _heartbeat_task.done():
+        _heartbeat_task = bot.loop.create_task(_heartbeat())
+
+
+async def _heartbeat():
+    """
+    Report this shards health to the supervisor until the bot shuts down
+    """
+    while True:
+        try:
+            write_shard_health(SHARD_ID, {
+                "shard_id": SHARD_ID,
+                "guilds": len(bot.guilds),
+                "initialized_guilds": sum(global_state.initialized for global_state in Guilds()),
+                "latency_ms": round(bot.latency * 1000, 1),
+                "boot_time": GlobalState.boot_time.isoformat(),
+            })
+        except Exception:
+            logger.exception("Failed to report our health")
+        await asyncio.sleep(SHARD_HEARTBEAT_SECONDS)
+
+
+async def _init_layer_messages(layer):
+    channel = layer.channel
+    # Wipe channel
+    await channel.purge(limit=None)
+    layer.status_message = await channel.send("I'm bootin' baby!")
+    layer.table_message = await channel.send("I'm bootin' baby!")
+
+
+async def _fetch_layer_messages(layer):
+    # Either the saved ids or, when reconnecting, the stale message objects
+    table_message_id = getattr(layer.table_message, "id", layer.table_message)
+    status_message_id = getattr(layer.status_message, "id", layer.status_message)
+    try:
+        layer.table_message = await layer.channel.fetch_message(table_message_id)
+        layer.status_message = await layer.channel.fetch_message(status_message_id)
+    except discord.NotFound:
+        logger.error(f"Could not find message {table_message_id}")
+        await layer.channel.send("Couldn't find my info message in here - Let Malzo know!")
+        return False
+    return True
+
+
 @bot.event
 async def on_message(message):
     # Ignore messages that we sent
@@ -111,31 +277,116 @@ async def on_message(message):
     if message.channel.type == discord.ChannelType.private:
         return
 
-    if message.channel.name not in AUTHORIZED_CHANNELS:
+    state = Guilds().for_channel(message.channel)
+    if not state.is_layer_channel(message.channel) and message.channel.name not in (LOTUS_TIMER_CHANNEL, ADMIN_CHANNEL):
         return
+    EventRecorder().message(message)
 
-    state = GlobalState()
-    while not state.initialized:
-        await asyncio.sleep(1)
+    if not state.initialized:
+        start = time.perf_counter()
+        if not await state.wait_until_initialized():
+            logger.warning(f"Startup backlog is full - dropping |{message.content}| from |{message.author.id}|")
+            Metrics().inc("lotus_messages_dropped_total")
+            return
+        if state.failed:
+            if message.content.startswith(PREFIX):
+                Feedback().notify(
+                    message.author,
+                    (
+                        f"You sent `{message.content}` in {message.channel.mention}\n"
+                        "I couldn't start up in this server, so I can't do that right now. Let an admin know!"
+                    )
+                )
+            return
+        logger.info(f"Message queued during startup waited |{(time.perf_counter() - start) * 1000:.1f}|ms")
+    Metrics().inc("lotus_messages_total")
     await bot.process_commands(message)
 
 
+@bot.event
+async def on_raw_reaction_add(payload):
+    await _on_spot_reaction(payload, signin=True)
+
+
+@bot.event
+async def on_raw_reaction_remove(payload):
+    await _on_spot_reaction(payload, signin=False)
+
+
+async def _on_spot_reaction(payload, signin):
+    """
+    Number reactions on a table message sign the user into/out of that spot, see REACTION_SIGNUPS
+    """
+    if not REACTION_SIGNUPS or payload.guild_id is None or payload.user_id == bot.user.id:
+        return
+    spot_num = REACTION_NUMBER_MAPPING.get(unqualified_emoji(payload.emoji.name))
+    channel = bot.get_channel(payload.channel_id)
+    state = Guilds().get(payload.guild_id)
+    if spot_num is None or channel is None or not state.is_layer_channel(channel):
+        return
+
+    if not state.initialized:
+        if not await state.wait_until_initialized():
+            logger.warning(f"Startup backlog is full - dropping reaction {payload.emoji.name} from |{payload.user_id}|")
+            return
+        if state.failed:
+            logger.warning(f"Guild failed to start up - dropping reaction {payload.emoji.name} from |{payload.user_id}|")
+            return
+    await _react_signup(channel, payload.message_id, spot_num, payload.user_id, payload.emoji, signin)
+
+
+@save_state
+async def _react_signup(channel, message_id, spot_num, user_id, emoji, signin):
+    global_state = Guilds().for_channel(channel)
+    zone_name, layer_num, state = global_state.get_state_for_channel(channel)
+    if message_id != state.table_message.id or spot_num not in state.spots:
+        return
+
+    spot_player = state.spots[spot_num].player
+    try:
+        if signin:
+            if spot_player == user_id:
+                return
+            global_state.claim_spots(zone_name, layer_num, [spot_num], user_id)
+        else:
+            # Also where we land after taking back a reaction that didnt sign anyone in
+            if spot_player != user_id:
+                return
+            global_state.release_spots(zone_name, layer_num, [spot_num], user_id)
+    except SignupError as e:
+        member = channel.guild.get_member(user_id)
+        if member is not None:
+            Feedback().notify(member, f"You reacted with {emoji} in {channel.mention}\n{e}")
+            # Their reaction would otherwise sit there looking like a signup
+            await OutboundScheduler().remove_reaction(state.table_message, emoji, member)
+        return
+    return channel
+
+
 @bot.event
 async def on_command_error(context, exception):
+    EventRecorder().command_error(context, exception)
+    # Commands that didnt make it through instrument (unknown ones, failed checks) arent tagged yet
+    fields = {"channel": context.message.channel.name, "user": context.message.author.id}
     if isinstance(exception, CommandNotFound):
-        logger.warning(f"Unrecognized command: |{context.message.content}|")
-        user_dm = await get_user_dm(context.message.author)
-        await user_dm.send(
+        logger.warning(f"Unrecognized command: |{context.message.content}|", extra=fields)
+        Feedback().notify(
+            context.message.author,
             (
                 f"You sent `{context.message.content}` in {context.channel.mention}\n"
                 "I do not recognize that command. Learn to type. Or read. Or both."
             )
         )
-        await context.message.delete()
+        OutboundScheduler().delete(context.message)
     elif isinstance(exception, MissingRole):
-        logger.warning(f"Missing role for user: |{context.message.author}| for message: |{context.message.content}")
-        user_dm = await get_user_dm(context.message.author)
-        await user_dm.send(
+        # Rejected before the command ran, so instrument never saw it
+        Metrics().inc("lotus_commands_total", command=str(context.command), outcome="missing_role")
+        logger.warning(
+            f"Missing role for user: |{context.message.author}| for message: |{context.message.content}",
+            extra={"command": str(context.command), **fields},
+        )
+        Feedback().notify(
+            context.message.author,
             (
                 f"You sent `{context.message.content}` in {context.channel.mention}\n"
                 "You do not have the permissions to use that command."
@@ -144,229 +395,269 @@ async def on_command_error(context, exception):
     else:
         logger.error(
             f"Exception in command |{context.command}|. On message |{context.message.content}|. From user |{context.message.author.display_name}|",
-            exc_info=(type(exception), exception, exception.__traceback__)
+            exc_info=(type(exception), exception, exception.__traceback__),
+            extra={"command": str(context.command), **fields},
         )
 
 
 @bot.command()
+@instrument
 @save_state
 @enforce_channels(*ZONE_CHANNELS)
 async def signin(ctx, *spot_nums):
-    # Remove duplicates
-    spot_nums = list(set(spot_nums))
-
     user = ctx.message.author
     channel = ctx.message.channel
-    user_dm = await get_user_dm(user)
-    zone_name, layer_num, state = GlobalState().get_state_for_channel(channel)
+    global_state = Guilds().for_channel(channel)
+    zone_name, layer_num, state = global_state.get_state_for_channel(channel)
 
-    if len(spot_nums) == 0:
-        await user_dm.send(
-            (
-                f"You sent `{ctx.message.content}` in {channel.mention}\n"
-                "You need to give me atleast one lotus spot number\n"
-                f"You can choose from the following: {[spot.number for spot in state.spots.values() if spot.player is None]}"
-            )
-        )
-        await ctx.message.delete()
+    try:
+        spot_nums = global_state.claim_spots(zone_name, layer_num, spot_nums, user.id)
+    except SignupError as e:
+        Feedback().notify(user, f"You sent `{ctx.message.content}` in {channel.mention}\n{e}")
+        OutboundScheduler().delete(ctx.message)
         return
 
-    for spot_num in spot_nums:
-        try:
-            int(spot_num)
-        except ValueError:
-            await user_dm.send(
-                (
-                    f"You sent `{ctx.message.content}` in {channel.mention}\n"
-                    "Pretty sure at least one of those aint a valid number\n"
-                    f"You can choose from the following: {[spot.number for spot in state.spots.values() if spot.player is None]}"
-                )
-            )
-            await ctx.message.delete()
-            return
+    lotus_spots = "\n".join([state.spots[spot_num].disc_message_fmt() for spot_num in spot_nums])
+    # Goes out in the background, the command doesnt wait on discord for it
+    DirectMessages().send(
+        user,
+        (
+            "Sign in confirmed!\n"
+            f"Zone: {zone_name} | Layer: {layer_num}\n"
+            f"{lotus_spots}"
+        )
+    )
+    OutboundScheduler().delete(ctx.message)
+    return ctx.channel
 
-        if spot_num not in state.spots:
-            await user_dm.send(
-                (
-                    f"You sent `{ctx.message.content}` in {channel.mention}\n"
-                    "Pretty sure atleast one of those aint a valid spot number\n"
-                    f"You can choose from the following: {[spot.number for spot in state.spots.values() if spot.player is None]}"
-                )
-            )
-            await ctx.message.delete()
-            return
 
-        spot = state.spots[spot_num]
-        if spot.player is not None:
-            await user_dm.send(
-                (
-                    f"You sent `{ctx.message.content}` in {channel.mention}\n"
-                    "At least one of those spots is already taken\n"
-                    f"You can choose from the following: {[spot.number for spot in state.spots.values() if spot.player is None]}"
-                )
-            )
-            await ctx.message.delete()
-            return
+@bot.command()
+@instrument
+@save_state
+@enforce_channels(*ZONE_CHANNELS)
+async def signout(ctx, *spot_nums):
+    user = ctx.message.author
+    channel = ctx.message.channel
+    global_state = Guilds().for_channel(channel)
+    zone_name, layer_num, state = global_state.get_state_for_channel(channel)
 
-    for spot_num in spot_nums:
-        spot = state.spots[spot_num]
-        spot.player = user
+    try:
+        spot_nums = global_state.release_spots(zone_name, layer_num, spot_nums, user.id)
+    except SignupError as e:
+        Feedback().notify(user, f"You sent `{ctx.message.content}` in {channel.mention}\n{e}")
+        OutboundScheduler().delete(ctx.message)
+        return
 
     lotus_spots = "\n".join([state.spots[spot_num].disc_message_fmt() for spot_num in spot_nums])
-    await user_dm.send(
+    # Goes out in the background, the command doesnt wait on discord for it
+    DirectMessages().send(
+        user,
         (
-            "Sign in confirmed!\n"
+            "Sign out confirmed!\n"
             f"Zone: {zone_name} | Layer: {layer_num}\n"
             f"{lotus_spots}"
         )
     )
-    await ctx.message.delete()
+    OutboundScheduler().delete(ctx.message)
     return ctx.channel
 
 
 @bot.command()
+@instrument
 @save_state
 @enforce_channels(*ZONE_CHANNELS)
-async def signout(ctx, *spot_nums):
-    # Remove duplicates
-    spot_nums = list(set(spot_nums))
-
+async def picked(ctx, minutes_ago="0", spot=None):
     user = ctx.message.author
     channel = ctx.message.channel
-    user_dm = await get_user_dm(user)
-    zone_name, layer_num, state = GlobalState().get_state_for_channel(channel)
+    global_state = Guilds().for_channel(channel)
+    zone_name, layer_num, state = global_state.get_state_for_channel(channel)
 
-    signedin_spots = [spot for spot in state.spots.values() if spot.player == user]
-    if not signedin_spots:
-        await user_dm.send(
+    try:
+        minutes_ago = int(minutes_ago)
+        if minutes_ago < 0:
+            raise ValueError
+        if spot is not None:
+            spot = int(spot)
+            if spot not in state.spots:
+                raise ValueError
+    except ValueError:
+        Feedback().notify(
+            user,
             (
                 f"You sent `{ctx.message.content}` in {channel.mention}\n"
-                "You can't sign out of spots if you're not signed into any in the first place"
+                "Tell me how many minutes ago the lotus was picked, or nothing if it was just now, "
+                "and which spot it was picked at if you know it"
             )
         )
-        await ctx.message.delete()
+        OutboundScheduler().delete(ctx.message)
         return
 
-    if len(spot_nums) == 0:
-        # signout from all the spots
-        for spot in signedin_spots:
-            spot.player = None
-        lotus_spots = "\n".join([spot.disc_message_fmt() for spot in signedin_spots])
-        await user_dm.send(
-            (
-                "Sign out confirmed!\n"
-                f"Zone: {zone_name} | Layer: {layer_num}\n"
-                f"{lotus_spots}"
-            )
-        )
-        await ctx.message.delete()
-        return channel
-
-    for spot_num in spot_nums:
-        try:
-            int(spot_num)
-        except ValueError:
-            await user_dm.send(
-                (
-                    f"You sent `{ctx.message.content}` in {channel.mention}\n"
-                    "Pretty sure at least one of those aint a valid number\n"
-                    f"You can choose from the following: {[spot.number for spot in signedin_spots]}"
-                )
-            )
-            await ctx.message.delete()
-            return
-
-        if spot_num not in state.spots:
-            await user_dm.send(
-                (
-                    f"You sent `{ctx.message.content}` in {channel.mention}\n"
-                    "Pretty sure atleast one of those aint a valid spot number\n"
-                    f"You can choose from the following: {[spot.number for spot in signedin_spots]}"
-                )
-            )
-            await ctx.message.delete()
-            return
+    if spot is None:
+        # Whoever holds a single spot on the layer most likely picked it there
+        user_spots = state.spots_of(user.id)
+        spot = user_spots[0] if len(user_spots) == 1 else None
+    global_state.record_pick(zone_name, layer_num, spot, datetime.now() - timedelta(minutes=minutes_ago))
+    LotusTimers().schedule(global_state, zone_name, layer_num)
+    OutboundScheduler().delete(ctx.message)
+    return ctx.channel
 
-        spot = state.spots[spot_num]
-        if spot.player != user:
-            await user_dm.send(
-                (
-                    f"You sent `{ctx.message.content}` in {channel.mention}\n"
-                    "At least one of those spots is taken by someone else or you aint signed into it\n"
-                    f"You can choose from the following: {[spot.number for spot in signedin_spots]}"
-                )
-            )
-            await ctx.message.delete()
-            return
 
-    for spot_num in spot_nums:
-        spot = state.spots[spot_num]
-        spot.player = None
+@bot.command()
+@instrument
+@enforce_channels(*ZONE_CHANNELS)
+async def whereami(ctx):
+    user = ctx.message.author
+    signups = Guilds().for_channel(ctx.message.channel).signups_for_player(user.id)
 
-    lotus_spots = "\n".join([state.spots[spot_num].disc_message_fmt() for spot_num in spot_nums])
-    await user_dm.send(
-        (
-            "Sign out confirmed!\n"
-            f"Zone: {zone_name} | Layer: {layer_num}\n"
-            f"{lotus_spots}"
-        )
-    )
-    await ctx.message.delete()
-    return ctx.channel
+    # Goes out in the background, the command doesnt wait on discord for it
+    if not signups:
+        DirectMessages().send(user, "You aren't signed into any spots")
+    else:
+        layers = "\n".join([
+            f"Zone: {zone_name} | Layer: {layer_num}\n" + "\n".join([spot.disc_message_fmt() for spot in spots])
+            for zone_name, layer_num, spots in signups
+        ])
+        DirectMessages().send(user, f"You're signed into:\n{layers}")
+    OutboundScheduler().delete(ctx.message)
 
 
 @bot.command()
+@instrument
 @has_role(ADMIN_ROLE_ID)
-@save_state
+@save_state(flush=True)
 @enforce_channels(*ZONE_CHANNELS)
 async def clear(ctx):
     user = ctx.message.author
     channel = ctx.message.channel
-    zone_name, layer_num, state = GlobalState().get_state_for_channel(channel)
+    global_state = Guilds().for_channel(channel)
+    zone_name, layer_num, state = global_state.get_state_for_channel(channel)
+
+    cleared_users = set(state.player_spots)
+    global_state.clear_layer(zone_name, layer_num)
+
+    notifications = []
+    for user_id in cleared_users:
+        user = channel.guild.get_member(user_id)
+        if user is None:
+            logger.warning(f"Failed to find cleared user with id |{user_id}|")
+            continue
+        notifications.append((user, f"You were cleared from {channel.mention}. Sign up again if you're still there!"))
+    # Goes out in the background, the command shouldnt wait on hundreds of DMs
+    DirectMessages().fan_out(notifications)
+
+    if REACTION_SIGNUPS:
+        # Drop everyones reactions along with their signups
+        reset_spot_reactions(state)
+    await OutboundScheduler().send(channel, "Signups where just cleared! Everyone get in @here!")
+    OutboundScheduler().delete(ctx.message)
+    return channel
 
-    cleared_users = set()
-    for spot in state.spots.values():
-        if spot.player is not None:
-            cleared_users.add(spot.player)
-            spot.player = None
 
-    for user in cleared_users:
-        user_dm = await get_user_dm(user)
-        await user_dm.send(f"You were cleared from {channel.mention}. Sign up again if you're still there!")
+@bot.command()
+@instrument
+@has_role(ADMIN_ROLE_ID)
+@enforce_channels(ADMIN_CHANNEL)
+async def metrics(ctx):
+    # Discord messages top out at 2000 characters
+    summary = Metrics().summary()[:1900] or "Nothing recorded yet"
+    await OutboundScheduler().send(ctx.message.channel, f"```\n{summary}\n```")
+    OutboundScheduler().delete(ctx.message)
 
-    await channel.send("Signups where just cleared! Everyone get in @here!")
-    await ctx.message.delete()
-    return channel
 
+@bot.command()
+@instrument
+@has_role(ADMIN_ROLE_ID)
+@enforce_channels(ADMIN_CHANNEL)
+async def trace(ctx, switch=None):
+    if switch in ("on", "off"):
+        tracer.enable(switch == "on")
+    await OutboundScheduler().send(
+        ctx.message.channel,
+        f"Tracing is {'on' if tracer.enabled else 'off'}, |{tracer.spans}| spans written to `{tracer.fp}`\n"
+        f"Usage: `{PREFIX}trace on` / `{PREFIX}trace off`"
+    )
+    OutboundScheduler().delete(ctx.message)
 
-if __name__ == "__main__":
-    logging.basicConfig(
-        # filename=f"{path.dirname(path.abspath(__file__))}/lootbot.log",
-        stream=sys.stdout,
-        level=logging.INFO,
-        filemode='a',
-        format="%(levelname)s:%(name)s:[%(asctime)s] %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S"
+
+@bot.command()
+@instrument
+@has_role(ADMIN_ROLE_ID)
+@enforce_channels(ADMIN_CHANNEL)
+async def profile(ctx, seconds="30"):
+    """
+    Sample every threads stack for seconds, tracing spans along the way, then post where the time went
+    """
+    channel = ctx.message.channel
+    OutboundScheduler().delete(ctx.message)
+    try:
+        seconds = int(seconds)
+    except ValueError:
+        seconds = 0
+    if not 0 < seconds <= PROFILER_MAX_SECONDS:
+        await OutboundScheduler().send(
+            channel, f"Usage: `{PREFIX}profile N`, N being 1 to {PROFILER_MAX_SECONDS} seconds"
+        )
+        return
+    if not profiler.start(seconds):
+        await OutboundScheduler().send(channel, "Already profiling, wait for that to finish")
+        return
+    await OutboundScheduler().send(channel, f"Profiling for {seconds} s")
+    # The command returns right away, the report comes once the profiler is done
+    asyncio.ensure_future(_report_profile(channel, tracer.enabled))
+    tracer.enable()
+
+
+async def _report_profile(channel, was_tracing):
+    try:
+        while profiler.running:
+            await asyncio.sleep(0.5)
+    finally:
+        tracer.enable(was_tracing)
+
+    shard = "" if SHARD_ID is None else f".{SHARD_ID}"
+    fp = path.join(ABSOLUTE_BASE_FP, f"lotus_profile-{datetime.now():%Y%m%d-%H%M%S}{shard}.folded")
+    try:
+        profiler.write(fp)
+    except OSError:
+        logger.exception(f"Failed to write the profile to |{fp}|")
+        fp = "nowhere, writing it failed"
+    total = sum(profiler.top.values()) or 1
+    top = "\n".join(
+        f"{count / total * 100:5.1f}% {function}" for function, count in profiler.top.most_common(15)
+    ) or "Nothing sampled"
+    logger.info(f"Profiled |{profiler.samples}| samples into |{fp}|")
+    await OutboundScheduler().send(
+        channel,
+        f"Profiled {profiler.samples} samples, collapsed stacks in `{fp}`\nOn top of the stack most often:\n"
+        f"```\n{top[:1700]}\n```"
     )
 
+
+if __name__ == "__main__":
+    # Written from a thread of its own, see logs.py
+    log_listener = setup_logging(level=logging.INFO, stream=sys.stdout)
+
     logging.getLogger("discord.gateway").setLevel(logging.WARNING)
 
     logging.info(" ")
     logging.info("-" * 50)
     logging.info(" ")
 
-    GlobalState().load_current_saved_state()
-    GlobalState().boot_time = datetime.now()
+    # Guilds load their state as they come up in on_ready
+    Guilds().storage_factory = get_storage
+    GlobalState.boot_time = datetime.now()
 
+    # supervisor.py restarts us when we go down, run `python supervisor.py` rather than this directly
+    if SHARD_ID is not None:
+        logger.info(f"!!! Running shard {SHARD_ID} of {SHARD_COUNT} !!!")
     try:
-        logger.info("Starting the endless loop")
-        boot_count = 0
-        while True:
-            boot_count += 1
-            logger.info(f"!!! Running the bot - {boot_count} !!!")
-            bot.run(DISCORD_TOKEN)
-            logger.info("Bot returned - rerunning in loop")
-    except RuntimeError:
-        logger.exception(f"Exiting messily. Boot count: {boot_count}")
+        bot.run(DISCORD_TOKEN)
     except Exception:
-        logger.exception(f"Lets see what hides here! Boot count: {boot_count}")
+        logger.exception("Lets see what hides here!")
+        sys.exit(1)
+    finally:
+        # The loop is gone along with any save that was still queued on it
+        Guilds().close()
+        EventRecorder().close()
+        tracer.close()
+        log_listener.stop()
@@ -0,0 +1,211 @@
+import asyncio
+import bisect
+import logging
+import time
+from functools import wraps
+
+from globals import SingletonMetaclass
+from settings import METRICS_HOST, METRICS_LATENCY_BUCKETS, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+
+# name -> (type, help) of everything we record
+METRICS = {
+    "lotus_command_seconds": ("histogram", "Time from a command being invoked until it returned"),
+    "lotus_commands_total": ("counter", "Commands invoked, by outcome - missing_role for the ones a check rejected"),
+    "lotus_render_seconds": ("histogram", "Time to re-render a layers embeds"),
+    "lotus_discord_requests_total": ("counter", "Requests made to discord, by kind and outcome"),
+    "lotus_discord_request_seconds": ("histogram", "Time a discord request took once it went out"),
+    "lotus_save_seconds": ("histogram", "Time to persist state, by what was persisted"),
+    "lotus_messages_total": ("counter", "Messages on_message handed over to the commands"),
+    "lotus_messages_dropped_total": ("counter", "Messages dropped because the startup backlog was full"),
+    "lotus_startup_backlog": ("gauge", "Messages waiting for their guild to start up"),
+    "lotus_outbound_queue_depth": ("gauge", "Discord requests queued in OutboundScheduler, by priority"),
+}
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count", "max")
+
+    def __init__(self):
+        # One count per bucket of METRICS_LATENCY_BUCKETS plus the +Inf one, not cumulative
+        self.counts = [0] * (len(METRICS_LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(METRICS_LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket the quantile falls in, capped at the largest value seen
+        """
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count and index < len(METRICS_LATENCY_BUCKETS):
+                return min(METRICS_LATENCY_BUCKETS[index], self.max)
+            if seen >= rank and count:
+                break
+        return self.max
+
+
+class Metrics(metaclass=SingletonMetaclass):
+    """
+    Counters, latency histograms and gauges, served in the prometheus text format on METRICS_HOST:METRICS_PORT.
+
+    Every metric has to be listed in METRICS. Labels are passed as keyword arguments, gauges are callbacks that
+    are only evaluated when the metrics are read.
+    """
+
+    def __init__(self):
+        # (name, labels) -> Histogram/value, labels being a sorted tuple of (label, value)
+        self._histograms = {}
+        self._counters = {}
+        # name -> (callback, label). The callback returns a number, or {label value: number} if there is a label
+        self._gauges = {}
+        self._server = None
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + amount
+
+    def gauge(self, name, callback, label=None):
+        self._gauges[name] = (callback, label)
+
+    def histogram(self, name, **labels):
+        return self._histograms.get((name, tuple(sorted(labels.items()))))
+
+    def render(self):
+        """
+        Everything in the prometheus text exposition format
+        """
+        samples = {}
+        for (name, labels), histogram in sorted(self._histograms.items(), key=_sort_key):
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(list(METRICS_LATENCY_BUCKETS) + ["+Inf"], histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        for (name, labels), value in sorted(self._counters.items(), key=_sort_key):
+            samples.setdefault(name, []).append(f"{name}{_labels(labels)} {value}")
+        for name, (callback, label) in self._gauges.items():
+            try:
+                value = callback()
+            except Exception:
+                logger.exception(f"Failed to read gauge |{name}|")
+                continue
+            if label is None:
+                samples.setdefault(name, []).append(f"{name} {value}")
+            else:
+                for label_value, label_count in value.items():
+                    samples.setdefault(name, []).append(f"{name}{_labels(((label, label_value),))} {label_count}")
+
+        out = []
+        for name in sorted(samples):
+            metric_type, help_text = METRICS[name]
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {metric_type}")
+            out.extend(samples[name])
+        return "\n".join(out) + "\n"
+
+    def summary(self):
+        """
+        Short human readable version for the metrics command
+        """
+        lines = []
+        for (name, labels), histogram in sorted(self._histograms.items(), key=_sort_key):
+            if not histogram.count:
+                continue
+            label_text = ",".join(str(label_value) for _, label_value in labels)
+            lines.append(
+                f"{name[len('lotus_'):]}{f'[{label_text}]' if label_text else ''}: {histogram.count}x "
+                f"p50<={histogram.quantile(0.5) * 1000:.0f}ms p99<={histogram.quantile(0.99) * 1000:.0f}ms "
+                f"max {histogram.max * 1000:.0f}ms"
+            )
+        for (name, labels), value in sorted(self._counters.items(), key=_sort_key):
+            label_text = ",".join(str(label_value) for _, label_value in labels)
+            lines.append(f"{name[len('lotus_'):]}{f'[{label_text}]' if label_text else ''}: {value}")
+        for name, (callback, label) in sorted(self._gauges.items()):
+            try:
+                lines.append(f"{name[len('lotus_'):]}: {callback()}")
+            except Exception:
+                continue
+        return "\n".join(lines)
+
+    async def start_server(self, port=METRICS_PORT):
+        """
+        Serve render() over http on METRICS_HOST:port, once - on_ready runs again on every reconnect. Does nothing if
+            port is None
+        """
+        if port is None or self._server is not None:
+            return
+        self._server = await asyncio.start_server(self._handle, METRICS_HOST, port)
+        logger.info(f"Serving metrics on |{METRICS_HOST}:{port}|")
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # The headers dont matter, just read past them
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found, try /metrics\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def timed(name, **labels):
+    """
+    Decorator to observe how long every call of a coroutine function takes into the name histogram
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                Metrics().observe(name, time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def _sort_key(item):
+    (name, labels), _ = item
+    return name, [(label, str(value)) for label, value in labels]
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{label}="{_escape(value)}"' for label, value in labels) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
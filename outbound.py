@@ -0,0 +1,236 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+import time
+
+import discord
+
+from globals import SingletonMetaclass
+from metrics import Metrics
+from settings import OUTBOUND_CONCURRENCY, OUTBOUND_DELETE_BATCH_SECONDS, OUTBOUND_RATE_LIMITS
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+# Priorities, lowest goes first. Edits of the embeds everyone is watching beat everything else. DMs a command
+#   sends its user beat bulk DMs to many users, so a fan-out never holds up a confirmation
+EDIT = 0
+ANNOUNCE = 1
+DM = 2
+FANOUT = 3
+DELETE = 4
+PRIORITY_NAMES = {EDIT: "edit", ANNOUNCE: "announce", DM: "dm", FANOUT: "fanout", DELETE: "delete"}
+
+
+class TokenBucket:
+    """
+    capacity requests per period seconds, refilled continuously
+    """
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """
+        Seconds until a request can go out, 0 if one can right now
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Job:
+    __slots__ = ("priority", "seq", "route", "factory", "future", "enqueued", "not_before", "context")
+
+    def __init__(self, priority, seq, route, factory, future, not_before):
+        self.priority = priority
+        self.seq = seq
+        self.route = route
+        self.factory = factory
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.not_before = not_before
+        # The request runs in the context of whoever queued it, so whatever they keep in contextvars goes along
+        self.context = contextvars.copy_context()
+
+
+class OutboundScheduler(metaclass=SingletonMetaclass):
+    """
+    Every request we make to discord while handling commands goes through here.
+
+    Requests are grouped into routes, (kind, channel id) with DMs keyed by their DM channel, each with its own token
+    bucket sized by OUTBOUND_RATE_LIMITS so we stay under discord's limits instead of running into 429s.
+    Out of the requests whose bucket has room, the highest priority one goes first: embed edits, then channel
+    announcements and reactions, then DMs, then fan-out DMs, then deletes and removed reactions. Deletes wait OUTBOUND_DELETE_BATCH_SECONDS and every delete queued for
+    a channel by then goes out as a single bulk delete. At most OUTBOUND_CONCURRENCY requests are in flight.
+
+    delete is fire and forget, everything else returns a future with the result of the request.
+    """
+
+    def __init__(self):
+        self._jobs = []
+        self._seq = itertools.count()
+        self._buckets = {}
+        # channel id -> messages waiting to be bulk deleted
+        self._pending_deletes = {}
+        self._in_flight = 0
+        self._wakeup = None
+        self._dispatcher = None
+        # priority -> [requests sent, total seconds queued, max seconds queued]
+        self._stats = {priority: [0, 0.0, 0.0] for priority in PRIORITY_NAMES}
+
+    def edit(self, message, **kwargs):
+        return self._submit(EDIT, ("edit", message.channel.id), lambda: message.edit(**kwargs))
+
+    def send(self, channel, *args, **kwargs):
+        return self._submit(ANNOUNCE, ("send", channel.id), lambda: channel.send(*args, **kwargs))
+
+    def dm(self, dm_channel, *args, **kwargs):
+        return self._submit(DM, ("dm", dm_channel.id), lambda: dm_channel.send(*args, **kwargs))
+
+    def fan_out_dm(self, dm_channel, *args, **kwargs):
+        return self._submit(FANOUT, ("dm", dm_channel.id), lambda: dm_channel.send(*args, **kwargs))
+
+    def add_reaction(self, message, emoji):
+        return self._submit(ANNOUNCE, ("react", message.channel.id), lambda: message.add_reaction(emoji))
+
+    def clear_reactions(self, message):
+        return self._submit(ANNOUNCE, ("react", message.channel.id), lambda: message.clear_reactions())
+
+    def remove_reaction(self, message, emoji, member):
+        return self._submit(DELETE, ("react", message.channel.id), lambda: message.remove_reaction(emoji, member))
+
+    def delete(self, message):
+        self._ensure_dispatcher()
+        channel = message.channel
+        pending = self._pending_deletes.setdefault(channel.id, [])
+        pending.append(message)
+        if len(pending) == 1:
+            self._submit(
+                DELETE,
+                ("delete", channel.id),
+                lambda: self._delete_batch(channel),
+                not_before=time.monotonic() + OUTBOUND_DELETE_BATCH_SECONDS,
+            )
+
+    def stats(self):
+        """
+        Queue depth, requests sent and time spent queued per priority
+        """
+        depths = {priority: 0 for priority in PRIORITY_NAMES}
+        for job in self._jobs:
+            depths[job.priority] += 1
+        return {
+            name: {
+                "depth": depths[priority],
+                "sent": self._stats[priority][0],
+                "wait_mean_ms": self._stats[priority][1] / self._stats[priority][0] * 1000 if self._stats[priority][0] else 0.0,
+                "wait_max_ms": self._stats[priority][2] * 1000,
+            }
+            for priority, name in PRIORITY_NAMES.items()
+        }
+
+    def _submit(self, priority, route, factory, not_before=0):
+        self._ensure_dispatcher()
+        future = asyncio.get_event_loop().create_future()
+        self._jobs.append(_Job(priority, next(self._seq), route, factory, future, not_before))
+        self._wakeup.set()
+        return future
+
+    def _ensure_dispatcher(self):
+        if self._wakeup is None:
+            # Created on first use so it belongs to the running event loop
+            self._wakeup = asyncio.Event()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+    async def _dispatch(self):
+        while True:
+            job, delay = self._next_job(time.monotonic())
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._jobs.remove(job)
+            self._bucket(job.route).take()
+            self._in_flight += 1
+            job.context.run(asyncio.ensure_future, self._run(job))
+
+    def _next_job(self, now):
+        """
+        The job to run next, or None and how long to sleep before something could be ready (None for until woken up)
+        """
+        if self._in_flight >= OUTBOUND_CONCURRENCY or not self._jobs:
+            return None, None
+        delay = None
+        for job in sorted(self._jobs, key=lambda job: (job.priority, job.seq)):
+            wait = max(job.not_before - now, self._bucket(job.route).wait_time(now))
+            if wait <= 0:
+                return job, None
+            delay = wait if delay is None else min(delay, wait)
+        return None, delay
+
+    def _bucket(self, route):
+        bucket = self._buckets.get(route)
+        if bucket is None:
+            bucket = self._buckets[route] = TokenBucket(*OUTBOUND_RATE_LIMITS[route[0]])
+        return bucket
+
+    async def _run(self, job):
+        waited = time.monotonic() - job.enqueued
+        stats = self._stats[job.priority]
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+        kind = job.route[0]
+        start = time.perf_counter()
+        try:
+            with span(f"discord {kind}", "discord", queued_ms=round(waited * 1000, 1)):
+                result = await job.factory()
+        except Exception as e:
+            Metrics().inc("lotus_discord_requests_total", kind=kind, outcome="error")
+            if not job.future.cancelled():
+                job.future.set_exception(e)
+        else:
+            Metrics().inc("lotus_discord_requests_total", kind=kind, outcome="ok")
+            if not job.future.cancelled():
+                job.future.set_result(result)
+        finally:
+            Metrics().observe("lotus_discord_request_seconds", time.perf_counter() - start, kind=kind)
+            self._in_flight -= 1
+            self._wakeup.set()
+
+    async def _delete_batch(self, channel):
+        messages = self._pending_deletes.pop(channel.id, [])
+        if len(messages) > 1:
+            try:
+                for start in range(0, len(messages), 100):
+                    await channel.delete_messages(messages[start:start + 100])
+                return
+            except discord.HTTPException:
+                # Bulk deletes refuse the whole batch if one message is already gone or too old
+                logger.warning(f"Bulk delete of |{len(messages)}| messages in |{channel.name}| failed - deleting one by one")
+        for message in messages:
+            try:
+                await message.delete()
+            except discord.NotFound:
+                pass
+            except discord.HTTPException:
+                logger.exception(f"Failed to delete message |{message.id}| in |{channel.name}|")
@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+from globals import atomic_write, json_dumps, json_loads
+from metrics import Metrics
+from settings import JOURNAL_COMPACT_BYTES, JOURNAL_FSYNC, JOURNAL_FSYNC_INTERVAL_SECONDS
+from tracing import traced
+
+logger = logging.getLogger(__name__)
+
+
+class StateSaver:
+    """
+    Saves a guilds GlobalState to its save file without blocking the event loop.
+
+    The snapshot is serialized on the loop (so it is consistent) and written to disk in a worker thread.
+    Saves requested while a write is in flight are coalesced into a single follow-up write of the latest state.
+    """
+
+    def __init__(self, global_state):
+        self.global_state = global_state
+        self._dirty = False
+        self._task = None
+        # Number of save requests folded into the next write
+        self._requests = 0
+        # Every snapshot gets a generation so a slow worker thread can never overwrite a newer save
+        self._generation = 0
+        self._written_generation = 0
+        self._write_lock = threading.Lock()
+        # Count of every save ever requested, and how many of those the last successful write covered
+        self._requested_total = 0
+        self._saved_total = 0
+
+    def request_save(self):
+        """
+        Schedule a save of the current state and return straight away
+        """
+        self._dirty = True
+        self._requests += 1
+        self._requested_total += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._write_pending())
+
+    async def flush(self):
+        """
+        Wait until every requested save has hit the disk
+        """
+        if self._task is not None and not self._task.done():
+            await asyncio.shield(self._task)
+
+    async def save(self):
+        """
+        Request a save and wait for it. Returns whether a snapshot taken after this call made it to disk.
+        """
+        self.request_save()
+        target = self._requested_total
+        await self.flush()
+        return self._saved_total >= target
+
+    def flush_sync(self):
+        """
+        Write the current state right now, blocking. Used on shutdown when the loop is gone.
+        """
+        self._dirty = False
+        self._requests = 0
+        self._generation += 1
+        self._write(self.global_state.serialize(), self._generation)
+
+    @traced()
+    async def _write_pending(self):
+        loop = asyncio.get_event_loop()
+        while self._dirty:
+            self._dirty = False
+            requests, self._requests = self._requests, 0
+            covered = self._requested_total
+            start = time.perf_counter()
+            data = self.global_state.serialize()
+            self._generation += 1
+            serialized = time.perf_counter()
+            try:
+                await loop.run_in_executor(None, self._write, data, self._generation)
+            except Exception:
+                logger.exception(f"Failed to save guild |{self.global_state.guild_id}| - will retry on the next save")
+                continue
+            self._saved_total = covered
+            done = time.perf_counter()
+            Metrics().observe("lotus_save_seconds", serialized - start, what="serialize")
+            Metrics().observe("lotus_save_seconds", done - serialized, what="snapshot")
+            logger.info(
+                f"Saved guild |{self.global_state.guild_id}| in |{(done - start) * 1000:.1f}|ms "
+                f"(serialize |{(serialized - start) * 1000:.1f}|ms). Coalesced |{requests - 1}| saves"
+            )
+
+    @traced()
+    def _write(self, data, generation):
+        with self._write_lock:
+            if generation <= self._written_generation:
+                return
+            atomic_write(self.global_state.save_fp, data)
+            self._written_generation = generation
+
+
+class Journal:
+    """
+    Append-only log of spot/timer mutations, one json object per line.
+
+    Appending costs the size of the mutation rather than the size of the whole state. Boot replays it on top
+    of the last snapshot. Once it grows past JOURNAL_COMPACT_BYTES it is compacted: the journal is moved aside,
+    a fresh snapshot (which already includes everything in it) is saved by saver, and only then is it deleted.
+    Entries are serialized on the event loop and written, flushed and fsynced in order by a single worker thread.
+    """
+
+    def __init__(self, fp, saver):
+        self.fp = fp
+        # Journal being folded into a snapshot by a compaction
+        self.compacting_fp = f"{fp}.compacting"
+        self.saver = saver
+        # A single worker keeps the appends, rotations and closes in the order they were made
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+        self._file = None
+        # Size of the journal as of the last write, kept by the worker
+        self._size = 0
+        # Pending fsync of the "interval" policy, see append()
+        self._fsync_timer = None
+        self._compaction = None
+
+    @traced()
+    def append(self, entry):
+        future = self._executor.submit(self._write, json_dumps(entry) + "\n")
+        future.add_done_callback(_log_failure)
+        if JOURNAL_FSYNC == "interval" and self._fsync_timer is None:
+            # Whatever gets appended until then is fsynced along with this, the last entry of a burst included
+            self._fsync_timer = asyncio.get_event_loop().call_later(JOURNAL_FSYNC_INTERVAL_SECONDS, self._fsync_later)
+
+    def submit(self, func, *args):
+        """
+        Run func on the journals worker thread, behind every append queued so far
+        """
+        return self._executor.submit(func, *args)
+
+    def replay(self, global_state):
+        # A journal left over from an interrupted compaction is older than the current one
+        for fp in (self.compacting_fp, self.fp):
+            try:
+                with open(fp, "r") as f:
+                    lines = f.readlines()
+            except FileNotFoundError:
+                continue
+            replayed = 0
+            for line_number, line in enumerate(lines, start=1):
+                try:
+                    entry = json_loads(line)
+                except ValueError:
+                    # Only a crash mid-append can leave a broken line, and that has to be the last one
+                    logger.warning(f"Stopping replay of |{fp}| at torn line |{line_number}|")
+                    break
+                global_state.apply(entry)
+                replayed += 1
+            logger.info(f"Replayed |{replayed}| journal entries from |{fp}|")
+
+    def maybe_compact(self):
+        """
+        Start a background compaction if the journal has grown past the threshold
+        """
+        if self._compaction is not None and not self._compaction.done():
+            return
+        if self._size < JOURNAL_COMPACT_BYTES:
+            return
+        self._compaction = asyncio.ensure_future(self._compact())
+
+    @traced()
+    async def _compact(self):
+        start = time.perf_counter()
+        # Behind every append queued so far, ahead of every one queued after
+        await asyncio.get_event_loop().run_in_executor(self._executor, self._rotate)
+        if not await self.saver.save():
+            logger.error(f"Snapshot failed - keeping |{self.compacting_fp}| for the next compaction")
+            return
+        os.remove(self.compacting_fp)
+        Metrics().observe("lotus_save_seconds", time.perf_counter() - start, what="compaction")
+        logger.info(f"Compacted journal into a snapshot in |{(time.perf_counter() - start) * 1000:.1f}|ms")
+
+    def _write(self, line):
+        start = time.perf_counter()
+        if self._file is None:
+            self._file = open(self.fp, "a")
+        self._file.write(line)
+        self._file.flush()
+        self._size = self._file.tell()
+        if JOURNAL_FSYNC == "always":
+            self._fsync()
+        Metrics().observe("lotus_save_seconds", time.perf_counter() - start, what="journal_append")
+
+    def _rotate(self):
+        self._close_file()
+        self._size = 0
+        if path.exists(self.compacting_fp):
+            # An earlier compaction never finished - keep its entries ahead of ours
+            with open(self.fp, "r") as src, open(self.compacting_fp, "a") as dst:
+                dst.write(src.read())
+            os.remove(self.fp)
+        else:
+            os.replace(self.fp, self.compacting_fp)
+
+    def close(self):
+        """
+        Write out every queued append and close the file, blocking. Used on shutdown when the loop is gone.
+        """
+        if self._fsync_timer is not None:
+            # Closing fsyncs anyway
+            self._fsync_timer.cancel()
+            self._fsync_timer = None
+        self._executor.submit(self._close_file).add_done_callback(_log_failure)
+        self._executor.shutdown(wait=True)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+
+    def _fsync_later(self):
+        self._fsync_timer = None
+        self._executor.submit(self._fsync_if_open).add_done_callback(_log_failure)
+
+    def _fsync_if_open(self):
+        # A rotation in the meantime already fsynced and closed it
+        if self._file is not None:
+            self._fsync()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._fsync()
+            self._file.close()
+            self._file = None
+
+    def _fsync(self):
+        os.fsync(self._file.fileno())
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.error("Failed to write to the journal", exc_info=future.exception())
@@ -0,0 +1,68 @@
+import json
+import logging
+import time
+from os import path
+
+from globals import ABSOLUTE_BASE_FP, SingletonMetaclass
+from settings import EVENT_LOG_FILENAME, RECORD_EVENTS
+from supervisor import shard_from_env
+
+logger = logging.getLogger(__name__)
+
+
+class EventRecorder(metaclass=SingletonMetaclass):
+    """
+    Writes the command messages we get, and the errors they run into, to the event log when RECORD_EVENTS is on.
+
+    One json object per line:
+        {"t": 1717171717.123, "ev": "message", "guild": 1, "channel": "epl-layer-1", "channel_id": 2, "author": 3,
+            "roles": [4], "content": ">signin 5"}
+        {"t": ..., "ev": "error", ... the same fields ..., "error": "CommandNotFound"}
+    roles are there so that admin commands can pass their role check on replay
+    """
+
+    def __init__(self):
+        self.enabled = RECORD_EVENTS
+        shard_id, _ = shard_from_env()
+        self.fp = path.join(
+            ABSOLUTE_BASE_FP, EVENT_LOG_FILENAME if shard_id is None else f"{EVENT_LOG_FILENAME}.{shard_id}"
+        )
+        self._file = None
+        self.recorded = 0
+
+    def message(self, message):
+        if self.enabled:
+            self._write("message", message)
+
+    def command_error(self, context, exception):
+        if self.enabled:
+            self._write("error", context.message, error=type(exception).__name__)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, event, message, **extra):
+        event = {
+            "t": round(time.time(), 3),
+            "ev": event,
+            "guild": message.guild.id if message.guild is not None else None,
+            "channel": message.channel.name,
+            "channel_id": message.channel.id,
+            "author": message.author.id,
+            "roles": [role.id for role in getattr(message.author, "roles", ())],
+            "content": message.content,
+            **extra,
+        }
+        try:
+            if self._file is None:
+                self._file = open(self.fp, "a")
+                logger.info(f"Recording events to |{self.fp}|")
+            self._file.write(json.dumps(event) + "\n")
+            self._file.flush()
+        except OSError:
+            logger.exception(f"Failed to record an event to |{self.fp}| - recording stopped")
+            self.enabled = False
+            return
+        self.recorded += 1
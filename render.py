@@ -0,0 +1,66 @@
+import asyncio
+import logging
+
+from globals import SingletonMetaclass
+from settings import RENDER_DEBOUNCE_SECONDS
+from utils import update_channel
+
+logger = logging.getLogger(__name__)
+
+
+class RenderScheduler(metaclass=SingletonMetaclass):
+    """
+    Coalesces embed re-renders per layer channel.
+
+    Mutations only mark a channel as dirty. A single task per channel waits out the debounce window and then
+    re-renders it once, no matter how many mutations landed in the meantime. Mutations that arrive while a
+    render is running are picked up by one more render straight after it.
+    """
+
+    def __init__(self):
+        # channel id -> channel waiting to be rendered
+        self._dirty = {}
+        # channel id -> render task
+        self._tasks = {}
+        # channel id -> event used to cut the debounce window short
+        self._wakeups = {}
+
+    def schedule(self, channel):
+        """
+        Mark the channel as dirty and return straight away. The render happens in the background.
+        """
+        self._dirty[channel.id] = channel
+        self._ensure_task(channel.id)
+
+    async def flush(self, channel):
+        """
+        Mark the channel as dirty and wait until it has been rendered
+        """
+        self._dirty[channel.id] = channel
+        task = self._ensure_task(channel.id)
+        self._wakeups[channel.id].set()
+        await asyncio.shield(task)
+
+    def _ensure_task(self, key):
+        task = self._tasks.get(key)
+        if task is None or task.done():
+            self._wakeups[key] = asyncio.Event()
+            task = asyncio.ensure_future(self._render_later(key))
+            self._tasks[key] = task
+        return task
+
+    async def _render_later(self, key):
+        try:
+            try:
+                await asyncio.wait_for(self._wakeups[key].wait(), timeout=RENDER_DEBOUNCE_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            while key in self._dirty:
+                channel = self._dirty.pop(key)
+                try:
+                    await update_channel(channel)
+                except Exception:
+                    logger.exception(f"Failed to render |{channel.name}|")
+        finally:
+            self._tasks.pop(key, None)
+            self._wakeups.pop(key, None)
@@ -66,7 +66,96 @@ ZONE_CHANNELS = [
 ]
 AUTHORIZED_CHANNELS = ZONE_CHANNELS + [LOTUS_TIMER_CHANNEL] + [ADMIN_CHANNEL]
 
+# Where the state lives: "json" for the SAVE_FILENAME snapshot + journal, "sqlite" for SQLITE_FILENAME.
+#   Switching to sqlite migrates an existing json save the first time it boots
+STATE_BACKEND = "json"
+# Every guild keeps its state files in a directory of its own, named after its id, under this one
+GUILD_STATE_DIR = "guilds"
 SAVE_FILENAME = "lotus_yoink.exe"
+SQLITE_FILENAME = "lotus_yoink.db"
+JOURNAL_FILENAME = "lotus_yoink.journal"
+# When to fsync the journal: "always" after every append, "interval" JOURNAL_FSYNC_INTERVAL_SECONDS after the first
+#   append that isnt fsynced yet, or "never" and leave it to the OS
+JOURNAL_FSYNC = "interval"
+JOURNAL_FSYNC_INTERVAL_SECONDS = 1.0
+# Fold the journal into a fresh snapshot once it gets this big
+JOURNAL_COMPACT_BYTES = 256 * 1024
+
+# How long an sqlite write waits for another process holding the database before giving up
+SQLITE_BUSY_TIMEOUT_MS = 5000
+
+# supervisor.py runs one worker process per shard
+SHARD_COUNT = 1
+# Workers report their health into this directory this often, and are restarted if they go quiet for the timeout
+SHARD_STATUS_DIR = "shards"
+SHARD_HEARTBEAT_SECONDS = 10
+SHARD_HEARTBEAT_TIMEOUT_SECONDS = 120
+# A worker that went down is restarted after the first delay, doubling up to the second while it keeps going down
+SHARD_RESTART_BACKOFF_SECONDS = (1, 60)
+SUPERVISOR_POLL_SECONDS = 1.0
+
+# How many layers on_ready reconciles with discord at once
+STARTUP_CONCURRENCY = 5
+# A guild that fails to start up (e.g. a layer channel is missing) turns its commands away and is retried after the
+#   first delay, doubling up to the second while it keeps failing
+GUILD_STARTUP_RETRY_SECONDS = (30, 600)
+# How many messages that arrive before on_ready has finished are held back for it, the rest are dropped
+STARTUP_BACKLOG_LIMIT = 100
+
+# Outbound discord requests: (requests, per seconds) for each route kind. Every channel gets a bucket of its own,
+#   DM channels too
+OUTBOUND_RATE_LIMITS = {
+    "edit": (5, 5.0),
+    "send": (5, 5.0),
+    "dm": (5, 5.0),
+    "delete": (5, 1.0),
+    "react": (1, 0.25),
+}
+# How many outbound requests can be in flight at once
+OUTBOUND_CONCURRENCY = 4
+# Deletes wait this long so that every delete queued for a channel in the meantime goes out as one bulk delete
+OUTBOUND_DELETE_BATCH_SECONDS = 0.5
+
+# DM channels kept around by user id, least recently used ones go first
+DM_CHANNEL_CACHE_SIZE = 1024
+# How many users a fan-out (e.g. everyone cleared from a layer) DMs at once, which is also how many of its DMs
+#   sit in the outbound queue at a time
+DM_FANOUT_CONCURRENCY = 10
+
+# Error notices for rejected commands are buffered per user for this long and sent as a single DM
+FEEDBACK_WINDOW_SECONDS = 2.0
+# Most notices a single feedback DM carries, the rest are dropped
+FEEDBACK_MAX_NOTICES = 10
+# Most feedback DMs a single user gets per minute
+FEEDBACK_MAX_DMS_PER_MINUTE = 3
+
+# Mutations landing within this many seconds of each other are rendered with a single edit per message
+RENDER_DEBOUNCE_SECONDS = 1.0
+
+# Metrics are served in the prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics (the port plus the
+#   shard id when sharded), None turns the endpoint off. Latencies are counted into buckets of these many seconds
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Tracing spans of the command path are written to TRACE_FILENAME as chrome trace events, to be loaded in
+#   chrome://tracing or ui.perfetto.dev. TRACING has them on from the start, >trace on/off in bot-admin toggles them
+TRACING = False
+TRACE_FILENAME = "lotus_trace.json"
+# >profile N in bot-admin samples every threads stack this often for N seconds, at most PROFILER_MAX_SECONDS
+PROFILER_INTERVAL_SECONDS = 0.005
+PROFILER_MAX_SECONDS = 300
+
+# Record every command message and command error to EVENT_LOG_FILENAME, to be replayed with benchmarks/replay.py.
+#   Only ids, channel names and message contents are written. Shards each write their own file
+RECORD_EVENTS = False
+EVENT_LOG_FILENAME = "lotus_events.jsonl"
+
+# Logs are written by a thread of their own. LOG_JSON writes them as one json object per line, with the command,
+#   channel, user and latency of the command they were logged in when there is one
+LOG_JSON = False
+# (records, seconds) - at most that many warnings/errors from any one logging call every that many seconds
+LOG_RATE_LIMIT = (20, 60)
 
 NUMBER_EMOJI_MAPPING = {
     1: ":one:",
@@ -81,8 +170,35 @@ NUMBER_EMOJI_MAPPING = {
     10: ":keycap_ten:"
 }
 
+# The same numbers as unicode emoji, which is what reactions are made of. Fully qualified (with U+FE0F), the way
+#   discord reports them
+NUMBER_REACTION_MAPPING = {
+    1: "1\N{VARIATION SELECTOR-16}\N{COMBINING ENCLOSING KEYCAP}",
+    2: "2\N{VARIATION SELECTOR-16}\N{COMBINING ENCLOSING KEYCAP}",
+    3: "3\N{VARIATION SELECTOR-16}\N{COMBINING ENCLOSING KEYCAP}",
+    4: "4\N{VARIATION SELECTOR-16}\N{COMBINING ENCLOSING KEYCAP}",
+    5: "5\N{VARIATION SELECTOR-16}\N{COMBINING ENCLOSING KEYCAP}",
+    6: "6\N{VARIATION SELECTOR-16}\N{COMBINING ENCLOSING KEYCAP}",
+    7: "7\N{VARIATION SELECTOR-16}\N{COMBINING ENCLOSING KEYCAP}",
+    8: "8\N{VARIATION SELECTOR-16}\N{COMBINING ENCLOSING KEYCAP}",
+    9: "9\N{VARIATION SELECTOR-16}\N{COMBINING ENCLOSING KEYCAP}",
+    10: "\N{KEYCAP TEN}",
+}
+# Sign in/out by adding/removing the number reactions on the table message, on top of the commands
+REACTION_SIGNUPS = False
+
 LOTUS_WINDOW_START_DELTA = timedelta(minutes=45)
 LOTUS_WINDOW_END_DELTA = timedelta(minutes=75)
+
+# Every pick a guild reports is appended to this file, the lotus windows are predicted from them
+PICKS_FILENAME = "lotus_yoink.picks"
+# Respawn times (the time between two picks in a row) outside of this range dont count - double reports of the
+#   same pick, or spawns nobody reported
+PREDICTION_RESPAWN_RANGE = (timedelta(minutes=15), timedelta(hours=3))
+# Respawn times a layer needs before its predicted window replaces the LOTUS_WINDOW_*_DELTA one
+PREDICTION_MIN_SAMPLES = 10
+# The predicted window runs between these percentiles of the respawn times
+PREDICTION_PERCENTILES = (10, 90)
 try:
     from local_settings import *  # NOQA
 except ImportError:
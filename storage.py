@@ -0,0 +1,297 @@
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from os import path
+
+from globals import guild_path
+from metrics import Metrics
+from persistence import Journal, StateSaver
+from settings import JOURNAL_FILENAME, SQLITE_BUSY_TIMEOUT_MS, SQLITE_FILENAME, STATE_BACKEND
+
+logger = logging.getLogger(__name__)
+
+
+def get_storage(global_state):
+    """
+    Storage backend picked by settings.STATE_BACKEND for a guilds state
+    """
+    if STATE_BACKEND == "json":
+        return JsonStorage(global_state)
+    if STATE_BACKEND == "sqlite":
+        return SqliteStorage(guild_path(global_state.guild_id, SQLITE_FILENAME))
+    raise ValueError(f"|{STATE_BACKEND}| is not a known state backend")
+
+
+class JsonStorage:
+    """
+    The guilds json save file plus its mutation journal.
+
+    load(state) - load the snapshot, or start fresh without one, and replay the journal on top of it
+    record(entry) - persist a single mutation that has just been applied to the state
+    checkpoint() - called after every command, a chance to do housekeeping in the background
+    save(state) - persist the whole state in the background
+    close(state) - persist the whole state right now, the event loop may already be gone
+    submit(func, *args) - run func on the thread that writes the storage, in order with everything else it writes
+    """
+
+    def __init__(self, global_state):
+        self.saver = StateSaver(global_state)
+        self.journal = Journal(guild_path(global_state.guild_id, JOURNAL_FILENAME), self.saver)
+
+    def load(self, global_state):
+        if not global_state.load_snapshot():
+            # The journal can outlive its snapshot (a crash before the first one was written, or a lost one).
+            #   Its entries hold absolute values, so they apply on top of a fresh state just as well
+            global_state.fresh_init()
+        # Whatever happened since the snapshot was taken
+        self.journal.replay(global_state)
+
+    def record(self, entry):
+        self.journal.append(entry)
+
+    def submit(self, func, *args):
+        return self.journal.submit(func, *args)
+
+    def checkpoint(self):
+        self.journal.maybe_compact()
+
+    def save(self, global_state):
+        self.saver.request_save()
+
+    def close(self, global_state):
+        self.saver.flush_sync()
+        self.journal.close()
+
+
+class SqliteStorage:
+    """
+    Zones, layers and spots as rows of an sqlite database in WAL mode.
+
+    A mutation only updates the rows it touched and is also kept in the mutations table for history.
+    Full saves diff every row against what was last written and only write the ones that changed.
+    All writes happen in order on a single worker thread so the event loop never waits on the disk.
+    If the database is empty and a json save file exists, load() migrates it over first.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS zones (
+            name TEXT PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS layers (
+            zone TEXT NOT NULL REFERENCES zones(name),
+            number INTEGER NOT NULL,
+            channel_name TEXT NOT NULL,
+            table_message INTEGER,
+            status_message INTEGER,
+            timer TEXT,
+            PRIMARY KEY (zone, number)
+        );
+        CREATE TABLE IF NOT EXISTS spots (
+            zone TEXT NOT NULL,
+            layer INTEGER NOT NULL,
+            number INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            player INTEGER,
+            PRIMARY KEY (zone, layer, number)
+        );
+        CREATE TABLE IF NOT EXISTS mutations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts TEXT NOT NULL,
+            op TEXT NOT NULL,
+            zone TEXT NOT NULL,
+            layer INTEGER NOT NULL,
+            spots TEXT,
+            player INTEGER,
+            timer TEXT
+        );
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self._connection = None
+        # A single worker keeps the writes in the order they were made
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        # zone names, (zone, layer) -> layer row and (zone, layer, spot) -> spot row as they were last written
+        self._zones = set()
+        self._layer_rows = {}
+        self._spot_rows = {}
+
+    def load(self, global_state):
+        self._connect()
+        if self._connection.execute("SELECT COUNT(*) FROM layers").fetchone()[0] == 0:
+            self._migrate_json(global_state)
+            return
+
+        saved_state = {}
+        for zone, number, channel_name, table_message, status_message, timer in self._connection.execute(
+            "SELECT zone, number, channel_name, table_message, status_message, timer FROM layers"
+        ):
+            self._zones.add(zone)
+            saved_state.setdefault(zone, {"layers": {}})["layers"][str(number)] = {
+                "channel": channel_name,
+                "channel_name": channel_name,
+                "table_message": table_message,
+                "status_message": status_message,
+                "timer": datetime.fromisoformat(timer) if timer else None,
+                "spots": {},
+            }
+            self._layer_rows[(zone, number)] = (channel_name, table_message, status_message, timer)
+        for zone, layer, number, name, player in self._connection.execute(
+            "SELECT zone, layer, number, name, player FROM spots"
+        ):
+            saved_state[zone]["layers"][str(layer)]["spots"][str(number)] = {
+                "name": name,
+                "number": number,
+                "player": player,
+            }
+            self._spot_rows[(zone, layer, number)] = (name, player)
+        global_state.load_saved_state({"state": saved_state})
+
+    def record(self, entry):
+        zone, layer = entry["zone"], int(entry["layer"])
+        op = entry["op"]
+        statements = []
+        if op == "signin":
+            player = _id(entry["player"])
+            for spot_num in entry["spots"]:
+                statements.append(self._spot_update(zone, layer, int(spot_num), player))
+        elif op == "signout":
+            for spot_num in entry["spots"]:
+                statements.append(self._spot_update(zone, layer, int(spot_num), None))
+        elif op == "clear":
+            for spot_key, (name, player) in self._spot_rows.items():
+                if spot_key[:2] == (zone, layer):
+                    self._spot_rows[spot_key] = (name, None)
+            statements.append(("UPDATE spots SET player = NULL WHERE zone = ? AND layer = ?", (zone, layer)))
+        elif op == "timer":
+            timer = _isoformat(entry["timer"])
+            layer_row = self._layer_rows.get((zone, layer))
+            if layer_row is not None:
+                self._layer_rows[(zone, layer)] = layer_row[:3] + (timer,)
+            statements.append(("UPDATE layers SET timer = ? WHERE zone = ? AND number = ?", (timer, zone, layer)))
+
+        statements.append((
+            "INSERT INTO mutations (ts, op, zone, layer, spots, player, timer) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                _isoformat(entry["ts"]),
+                op,
+                zone,
+                layer,
+                ",".join(str(spot_num) for spot_num in entry.get("spots", [])) or None,
+                _id(entry.get("player")),
+                _isoformat(entry.get("timer")),
+            ),
+        ))
+        self._submit(statements)
+
+    def submit(self, func, *args):
+        return self._executor.submit(func, *args)
+
+    def checkpoint(self):
+        pass
+
+    def save(self, global_state):
+        statements = self._diff(global_state)
+        if statements:
+            self._submit(statements)
+
+    def close(self, global_state):
+        statements = self._diff(global_state)
+        if statements:
+            self._submit(statements)
+        self._executor.shutdown(wait=True)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    def _connect(self):
+        if self._connection is not None:
+            return
+        self._connection = sqlite3.connect(self.fp, check_same_thread=False, isolation_level=None)
+        self._connection.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(self.SCHEMA)
+
+    def _migrate_json(self, global_state):
+        if not path.exists(global_state.save_fp):
+            logger.info("Empty database and no json save file to migrate")
+            return
+        JsonStorage(global_state).load(global_state)
+        start = time.perf_counter()
+        self._execute(self._diff(global_state))
+        logger.info(f"Migrated the json save file into |{self.fp}| in |{(time.perf_counter() - start) * 1000:.1f}|ms")
+
+    def _spot_update(self, zone, layer, spot_num, player):
+        spot_row = self._spot_rows.get((zone, layer, spot_num))
+        if spot_row is not None:
+            self._spot_rows[(zone, layer, spot_num)] = (spot_row[0], player)
+        return (
+            "UPDATE spots SET player = ? WHERE zone = ? AND layer = ? AND number = ?",
+            (player, zone, layer, spot_num),
+        )
+
+    def _diff(self, global_state):
+        """
+        Upserts for every layer/spot row that differs from what was last written
+        """
+        statements = []
+        for zone_name, zone in global_state.state.items():
+            if zone_name not in self._zones:
+                self._zones.add(zone_name)
+                statements.append(("INSERT OR IGNORE INTO zones (name) VALUES (?)", (zone_name,)))
+            for layer_number, layer in zone.layers.items():
+                layer_key = (zone_name, int(layer_number))
+                layer_row = (
+                    layer.channel_name,
+                    _id(layer.table_message),
+                    _id(layer.status_message),
+                    _isoformat(layer.timer),
+                )
+                if self._layer_rows.get(layer_key) != layer_row:
+                    self._layer_rows[layer_key] = layer_row
+                    statements.append((
+                        "INSERT OR REPLACE INTO layers "
+                        "(zone, number, channel_name, table_message, status_message, timer) VALUES (?, ?, ?, ?, ?, ?)",
+                        layer_key + layer_row,
+                    ))
+                for spot_number, spot in layer.spots.items():
+                    spot_key = layer_key + (int(spot_number),)
+                    spot_row = (spot.name, _id(spot.player))
+                    if self._spot_rows.get(spot_key) != spot_row:
+                        self._spot_rows[spot_key] = spot_row
+                        statements.append((
+                            "INSERT OR REPLACE INTO spots (zone, layer, number, name, player) VALUES (?, ?, ?, ?, ?)",
+                            spot_key + spot_row,
+                        ))
+        return statements
+
+    def _submit(self, statements):
+        future = self._executor.submit(self._execute, statements)
+        future.add_done_callback(_log_failure)
+
+    def _execute(self, statements):
+        # Saving a state that was never loaded from here is fine too
+        self._connect()
+        start = time.perf_counter()
+        with self._connection:
+            self._connection.execute("BEGIN")
+            for sql, params in statements:
+                self._connection.execute(sql, params)
+        Metrics().observe("lotus_save_seconds", time.perf_counter() - start, what="sqlite")
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.error("Failed to write to the sqlite database", exc_info=future.exception())
+
+
+def _id(obj):
+    """
+    Discord objects are stored by their id
+    """
+    return getattr(obj, "id", obj)
+
+
+def _isoformat(timestamp):
+    return timestamp.isoformat() if timestamp is not None else None
@@ -0,0 +1,201 @@
+"""
+Runs the bot as SHARD_COUNT worker processes, one discord shard each, and keeps them running.
+
+    python supervisor.py
+
+Discord hands every guild to exactly one shard, so each worker only ever loads and writes the state of its own
+guilds. The guild state directories are shared on the local disk, every worker holds a lock on the guilds it has
+loaded (see Guilds) so two processes can never write the same guild.
+
+Workers write their health to SHARD_STATUS_DIR every SHARD_HEARTBEAT_SECONDS. A worker that exits or stops writing
+its health for SHARD_HEARTBEAT_TIMEOUT_SECONDS is restarted, waiting longer after every restart that comes
+quickly after the last one. The health of every worker is gathered into one file and logged.
+"""
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+from datetime import datetime
+from os import path
+
+from globals import ABSOLUTE_BASE_FP, atomic_write
+from settings import (
+    SHARD_COUNT, SHARD_HEARTBEAT_TIMEOUT_SECONDS, SHARD_RESTART_BACKOFF_SECONDS, SHARD_STATUS_DIR,
+    SUPERVISOR_POLL_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+
+# How a worker is told which shard it runs
+SHARD_ID_ENV = "LOTUS_SHARD_ID"
+SHARD_COUNT_ENV = "LOTUS_SHARD_COUNT"
+
+ABSOLUTE_SHARD_STATUS_FP = path.join(ABSOLUTE_BASE_FP, SHARD_STATUS_DIR)
+ABSOLUTE_MAIN_FP = path.join(ABSOLUTE_BASE_FP, "main.py")
+
+
+def shard_from_env():
+    """
+    (shard id, shard count) this process was started as, (None, None) when it wasnt started by the supervisor
+    """
+    if SHARD_ID_ENV not in os.environ:
+        return None, None
+    return int(os.environ[SHARD_ID_ENV]), int(os.environ[SHARD_COUNT_ENV])
+
+
+def shard_health_fp(shard_id):
+    return path.join(ABSOLUTE_SHARD_STATUS_FP, f"shard-{shard_id}.json")
+
+
+def write_shard_health(shard_id, health):
+    """
+    Called by a worker to report in. health is a json serializable dict
+    """
+    os.makedirs(ABSOLUTE_SHARD_STATUS_FP, exist_ok=True)
+    atomic_write(shard_health_fp(shard_id), json.dumps({"ts": time.time(), "pid": os.getpid(), **health}))
+
+
+def read_shard_health(shard_id):
+    try:
+        with open(shard_health_fp(shard_id), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class Worker:
+    """
+    One worker process and its restart bookkeeping
+    """
+
+    def __init__(self, shard_id, shard_count):
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.backoff = SHARD_RESTART_BACKOFF_SECONDS[0]
+        # When the worker can be started again after it went down
+        self.restart_at = 0
+
+    def start(self):
+        env = dict(os.environ)
+        env[SHARD_ID_ENV] = str(self.shard_id)
+        env[SHARD_COUNT_ENV] = str(self.shard_count)
+        self.process = subprocess.Popen([sys.executable, ABSOLUTE_MAIN_FP], env=env, cwd=ABSOLUTE_BASE_FP)
+        self.started = time.time()
+        logger.info(f"Started shard |{self.shard_id}| as pid |{self.process.pid}|")
+
+    def stop(self, timeout=30):
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Shard |{self.shard_id}| didnt stop in |{timeout}|s - killing it")
+            self.process.kill()
+            self.process.wait()
+
+    def check(self, now):
+        """
+        Restart the worker if it is down or stuck. Returns its health as last reported
+        """
+        health = read_shard_health(self.shard_id)
+        if self.process is None:
+            if now >= self.restart_at:
+                self.start()
+            return health
+
+        exit_code = self.process.poll()
+        if exit_code is None:
+            # Reports from a previous run of the worker dont count
+            last_seen = max(self.started, health["ts"] if health is not None else 0)
+            if now - last_seen < SHARD_HEARTBEAT_TIMEOUT_SECONDS:
+                return health
+            logger.error(f"Shard |{self.shard_id}| hasnt reported in for |{now - last_seen:.0f}|s - restarting it")
+            self.stop()
+        else:
+            logger.error(f"Shard |{self.shard_id}| exited with |{exit_code}|")
+
+        # Quick deaths back off further and further, a worker that ran for a while starts over
+        if now - self.started > SHARD_RESTART_BACKOFF_SECONDS[1]:
+            self.backoff = SHARD_RESTART_BACKOFF_SECONDS[0]
+        logger.info(f"Restarting shard |{self.shard_id}| in |{self.backoff:.0f}|s")
+        self.process = None
+        self.restarts += 1
+        self.restart_at = now + self.backoff
+        self.backoff = min(self.backoff * 2, SHARD_RESTART_BACKOFF_SECONDS[1])
+        return health
+
+
+class Supervisor:
+    def __init__(self, shard_count=SHARD_COUNT):
+        self.workers = [Worker(shard_id, shard_count) for shard_id in range(shard_count)]
+        self._stopping = False
+        self._last_counts = None
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        logger.info(f"Supervising |{len(self.workers)}| shards")
+        try:
+            while not self._stopping:
+                now = time.time()
+                healths = {worker.shard_id: worker.check(now) for worker in self.workers}
+                self._report(now, healths)
+                time.sleep(SUPERVISOR_POLL_SECONDS)
+        finally:
+            for worker in self.workers:
+                worker.stop()
+            logger.info("Stopped every shard")
+
+    def _stop(self, signum, frame):
+        logger.info(f"Got signal |{signum}| - stopping")
+        self._stopping = True
+
+    def _report(self, now, healths):
+        shards = {}
+        for worker in self.workers:
+            health = healths[worker.shard_id] or {}
+            shards[worker.shard_id] = {
+                "running": worker.process is not None and worker.process.poll() is None,
+                "restarts": worker.restarts,
+                "seconds_since_report": round(now - health["ts"], 1) if "ts" in health else None,
+                **health,
+            }
+        running = sum(shard["running"] for shard in shards.values())
+        summary = {
+            "ts": now,
+            "time": datetime.fromtimestamp(now).isoformat(),
+            "running": running,
+            "shards": len(shards),
+            "guilds": sum(shard.get("guilds", 0) for shard in shards.values()),
+            "initialized_guilds": sum(shard.get("initialized_guilds", 0) for shard in shards.values()),
+            "restarts": sum(shard["restarts"] for shard in shards.values()),
+            "per_shard": shards,
+        }
+        os.makedirs(ABSOLUTE_SHARD_STATUS_FP, exist_ok=True)
+        atomic_write(path.join(ABSOLUTE_SHARD_STATUS_FP, "health.json"), json.dumps(summary, indent=2))
+
+        counts = (running, summary["initialized_guilds"], summary["guilds"], summary["restarts"])
+        if counts != self._last_counts:
+            self._last_counts = counts
+            logger.info(
+                f"|{running}| of |{len(shards)}| shards running, |{summary['initialized_guilds']}| of "
+                f"|{summary['guilds']}| guilds up, |{summary['restarts']}| restarts"
+            )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format="%(levelname)s:%(name)s:[%(asctime)s] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+    Supervisor().run()
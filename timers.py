@@ -0,0 +1,123 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import datetime
+
+from globals import Guilds, SingletonMetaclass
+from outbound import OutboundScheduler
+from render import RenderScheduler
+from settings import LOTUS_TIMER_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+
+WINDOW_OPEN = "open"
+WINDOW_CLOSE = "close"
+
+
+class LotusTimers(metaclass=SingletonMetaclass):
+    """
+    Calls out lotus windows opening and closing in LOTUS_TIMER_CHANNEL and re-renders the layers status at both.
+
+    Every pending callout of every guild sits in one heap ordered by when it is due, and a single task sleeps
+    until the earliest one. Re-picking a layer doesnt dig its old callouts out of the heap - they are skipped
+    when they come up because the layers timer has moved on since. Nothing about the heap is persisted, it is
+    rebuilt from the layers timers when a guild starts up.
+    """
+
+    def __init__(self):
+        # (due, seq, kind, guild id, zone name, layer number, timer it was scheduled for)
+        self._heap = []
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self.fired = 0
+        self.skipped = 0
+
+    def schedule(self, global_state, zone_name, layer_number):
+        """
+        Queue the callouts for the layers current timer, the ones already in the past are left out
+        """
+        window = global_state.lotus_window(zone_name, layer_number)
+        if window is None:
+            return
+        timer = global_state.state[zone_name].layers[layer_number].timer
+        self._ensure_task()
+        now = datetime.now()
+        for kind, due in zip((WINDOW_OPEN, WINDOW_CLOSE), window):
+            if due > now:
+                heapq.heappush(
+                    self._heap, (due, next(self._seq), kind, global_state.guild_id, zone_name, layer_number, timer)
+                )
+        # The task may be asleep until a later callout
+        self._wakeup.set()
+
+    def rebuild(self, global_state):
+        """
+        Queue the callouts of every layer of the guild, e.g. after a restart
+        """
+        for zone_name, zone in global_state.state.items():
+            for layer_number, layer_state in zone.layers.items():
+                self.schedule(global_state, zone_name, layer_number)
+
+    def pending(self):
+        return len(self._heap)
+
+    def _ensure_task(self):
+        if self._wakeup is None:
+            # Created on first use so it belongs to the running event loop
+            self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = None
+            if self._heap:
+                timeout = (self._heap[0][0] - datetime.now()).total_seconds()
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            due, _, kind, guild_id, zone_name, layer_number, timer = heapq.heappop(self._heap)
+            # A slow send shouldnt hold up the callouts due right after it
+            asyncio.ensure_future(self._fire(kind, guild_id, zone_name, layer_number, timer))
+
+    async def _fire(self, kind, guild_id, zone_name, layer_number, timer):
+        try:
+            await self._call_out(kind, guild_id, zone_name, layer_number, timer)
+        except Exception:
+            logger.exception(f"Failed to call out window {kind} for |{zone_name}| layer |{layer_number}|")
+
+    async def _call_out(self, kind, guild_id, zone_name, layer_number, timer):
+        global_state = Guilds().get(guild_id)
+        layer_state = global_state.state[zone_name].layers[layer_number]
+        if layer_state.timer != timer:
+            # Picked again since, that pick has its own callouts
+            self.skipped += 1
+            return
+        self.fired += 1
+
+        channel = layer_state.channel
+        # The status embed says whether the window is open
+        global_state.mark_mutated(channel)
+        RenderScheduler().schedule(channel)
+
+        callout_channel = next((c for c in channel.guild.channels if c.name == LOTUS_TIMER_CHANNEL), None)
+        if callout_channel is None:
+            logger.warning(f"No |{LOTUS_TIMER_CHANNEL}| channel in {channel.guild.name} to call out lotus windows in")
+            return
+        if kind == WINDOW_OPEN:
+            _, window_close = global_state.lotus_window(zone_name, layer_number)
+            message = (
+                f"@here Lotus window is open in {zone_name} | Layer {layer_number} ({channel.mention})! "
+                f"Closes at {window_close.strftime('%H:%M')}"
+            )
+        else:
+            message = f"Lotus window closed in {zone_name} | Layer {layer_number} ({channel.mention})"
+        await OutboundScheduler().send(callout_channel, message)
@@ -0,0 +1,244 @@
+"""
+Tracing spans of the command path and a sampling profiler, both meant to be switched on while the bot is running.
+
+Spans are written as chrome trace events, one per line, to TRACE_FILENAME. The file opens with "[" and every line
+ends in ",", which chrome://tracing and ui.perfetto.dev load as it is. A span started while another one is open
+in the same task (or in the task/OutboundScheduler request it started) is its child and shares its lane.
+
+Nothing here may import globals, globals uses it. So there are module level instances instead of singletons.
+"""
+import asyncio
+import collections
+import contextvars
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from functools import wraps
+from os import path
+
+from settings import PROFILER_INTERVAL_SECONDS, PROFILER_MAX_SECONDS, TRACE_FILENAME, TRACING
+
+logger = logging.getLogger(__name__)
+
+
+ABSOLUTE_BASE_FP = path.dirname(path.abspath(__file__))
+
+# (lane, span id) of the span open in this context, None outside of any
+_current = contextvars.ContextVar("span", default=None)
+
+
+class _NoSpan:
+    """
+    What span() hands out while tracing is off - costs an attribute lookup and nothing else
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "category", "args", "start", "lane", "token")
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        parent = _current.get()
+        span_id = next(self.tracer._ids)
+        # Every top level span gets a lane of its own, its children draw under it
+        self.lane = parent[0] if parent is not None else span_id
+        self.token = _current.set((self.lane, span_id))
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        end = time.perf_counter_ns()
+        _current.reset(self.token)
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer._emit(self, end)
+        return False
+
+    def set(self, **args):
+        """
+        Attach more args to the span, e.g. a result only known at the end
+        """
+        self.args.update(args)
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = TRACING
+        self.fp = path.join(ABSOLUTE_BASE_FP, TRACE_FILENAME)
+        self._file = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.spans = 0
+
+    def span(self, name, category="bot", **args):
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name, category, args)
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        if not enabled:
+            self.close()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _emit(self, span, end):
+        event = {
+            "name": span.name,
+            "cat": span.category,
+            "ph": "X",
+            "ts": span.start // 1000,
+            "dur": (end - span.start) // 1000,
+            "pid": os.getpid(),
+            "tid": span.lane,
+        }
+        if span.args:
+            event["args"] = {
+                key: value if isinstance(value, (int, float, bool)) else str(value) for key, value in span.args.items()
+            }
+        line = json.dumps(event) + ",\n"
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._file = open(self.fp, "a")
+                    if self._file.tell() == 0:
+                        self._file.write("[\n")
+                self._file.write(line)
+                # Top level spans are few enough to flush after every one
+                if _current.get() is None:
+                    self._file.flush()
+            except OSError:
+                logger.exception(f"Failed to write a span to |{self.fp}| - tracing turned off")
+                self.enabled = False
+                return
+        self.spans += 1
+
+
+tracer = Tracer()
+
+
+def span(name, category="bot", **args):
+    """
+    with span("claim_spots", spots=3): ...
+    """
+    return tracer.span(name, category, **args)
+
+
+def traced(name=None, category="bot"):
+    """
+    Decorator to trace every call of a function or coroutine function as a span named after it
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not tracer.enabled:
+                    return await func(*args, **kwargs)
+                with tracer.span(span_name, category):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(span_name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of every thread every PROFILER_INTERVAL_SECONDS from a thread of its own, for as long as
+    it is asked to. The result is a collapsed stacks file ("outer;inner;innermost count" per line) for
+    flamegraph.pl or speedscope.app, plus the functions that were seen on top of a stack most often.
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._stop = threading.Event()
+        # collapsed stack -> samples, and function -> samples it was on top of the stack
+        self.stacks = collections.Counter()
+        self.top = collections.Counter()
+        self.samples = 0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds):
+        """
+        Sample for seconds (capped at PROFILER_MAX_SECONDS) in the background. Returns False if already running
+        """
+        if self.running:
+            return False
+        self.stacks = collections.Counter()
+        self.top = collections.Counter()
+        self.samples = 0
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._sample, args=(min(seconds, PROFILER_MAX_SECONDS),), name="profiler", daemon=True
+        )
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def write(self, fp):
+        with open(fp, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def _sample(self, seconds):
+        own_id = threading.get_ident()
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        deadline = time.monotonic() + seconds
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                if thread_id not in thread_names:
+                    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+                self.top[stack[0]] += 1
+            self.samples += 1
+            self._stop.wait(PROFILER_INTERVAL_SECONDS)
+
+
+profiler = SamplingProfiler()
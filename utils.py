@@ -1,20 +1,82 @@
+import asyncio
+import hashlib
+import json
+import logging
+from datetime import datetime
+
 import discord
 
-from globals import GlobalState
-from settings import LOTUS_WINDOW_END_DELTA, LOTUS_WINDOW_START_DELTA
+from globals import Guilds, SingletonMetaclass
+from metrics import timed
+from outbound import OutboundScheduler
+from settings import NUMBER_REACTION_MAPPING
+from tracing import traced
+
+logger = logging.getLogger(__name__)
 
 # trick yoinked from raid-helper bot to get blank name/value in fields
 BLANK = b'\xe2\x80\x8e'.decode()
 DATE_FMT = "%d/%m/%Y at %H:%M"
 
 
+class EmbedCache(metaclass=SingletonMetaclass):
+    """
+    Remembers what was last rendered into each message so that edits which wouldnt change anything are skipped.
+    A message is considered current when either the layer version it was rendered at hasnt moved,
+    or the freshly rendered embed hashes to the same digest as the one already in the message.
+    """
+
+    def __init__(self):
+        # message id -> (layer version, embed digest)
+        self._rendered = {}
+        self.hits = 0
+        self.misses = 0
+
+    def is_current(self, message, version):
+        rendered = self._rendered.get(message.id)
+        if rendered is not None and rendered[0] == version:
+            self.hits += 1
+            return True
+        return False
+
+    @traced()
+    async def edit(self, message, version, embed):
+        """
+        Edit the message with the embed unless it already holds that exact embed
+        """
+        digest = embed_digest(embed)
+        rendered = self._rendered.get(message.id)
+        if rendered is not None and rendered[1] == digest:
+            self.hits += 1
+            self._rendered[message.id] = (version, digest)
+            return
+        self.misses += 1
+        await OutboundScheduler().edit(message, embed=embed, content="")
+        self._rendered[message.id] = (version, digest)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def embed_digest(embed):
+    payload = json.dumps(embed.to_dict(), sort_keys=True)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+@timed("lotus_render_seconds")
+@traced()
 async def update_channel(channel):
-    await _update_status_message(channel)
-    await _update_table_message(channel)
+    global_state = Guilds().for_channel(channel)
+    zone_name, layer_num, state = global_state.get_state_for_channel(channel)
+    await _update_status_message(global_state, zone_name, layer_num, state)
+    await _update_table_message(zone_name, layer_num, state)
 
 
-async def _update_status_message(channel):
-    zone_name, layer_num, state = GlobalState().get_state_for_channel(channel)
+@traced()
+async def _update_status_message(global_state, zone_name, layer_num, state):
+    cache = EmbedCache()
+    if cache.is_current(state.status_message, state.version):
+        return
 
     status_embed = discord.Embed(
         title=f"{zone_name} | Layer {layer_num}",
@@ -35,25 +97,32 @@ async def _update_status_message(channel):
             name=BLANK,
             value=(
                 "**Free spots:**\n"
-                f"{len([spot for spot in state.spots.values() if spot.player is None])}"
+                f"{state.free_count()}"
             )
         )
-        window_open = state.timer + LOTUS_WINDOW_START_DELTA
+        window_open, window_close = global_state.lotus_window(zone_name, layer_num)
+        # timers.LotusTimers re-renders this when the window opens and closes
+        now = datetime.now()
+        if now < window_open:
+            open_label, close_label = "Next lotus window opens:", "Next lotus window closes:"
+        elif now < window_close:
+            open_label, close_label = "Lotus window is OPEN since:", "Lotus window closes:"
+        else:
+            open_label, close_label = "Lotus window opened:", "Lotus window closed:"
         status_embed.add_field(
             name=BLANK,
             value=(
                 "```diff\n"
-                f"+ Next lotus window opens:\n"
+                f"+ {open_label}\n"
                 f"+ {window_open.strftime(DATE_FMT)}"
                 "```"
             ),
         )
-        window_close = state.timer + LOTUS_WINDOW_END_DELTA
         status_embed.add_field(
             name=BLANK,
             value=(
                 "```diff\n"
-                f"- Next lotus window closes:\n"
+                f"- {close_label}\n"
                 f"- {window_close.strftime(DATE_FMT)}"
                 "```"
             ),
@@ -74,7 +143,7 @@ async def _update_status_message(channel):
             name=BLANK,
             value=(
                 "**Free spots:**\n"
-                f"{len([spot for spot in state.spots.values() if spot.player is None])}"
+                f"{state.free_count()}"
             )
         )
         status_embed.add_field(
@@ -96,11 +165,14 @@ async def _update_status_message(channel):
             ),
         )
 
-    await state.status_message.edit(embed=status_embed, content="")
+    await cache.edit(state.status_message, state.version, status_embed)
 
 
-async def _update_table_message(channel):
-    zone_name, layer_num, state = GlobalState().get_state_for_channel(channel)
+@traced()
+async def _update_table_message(zone_name, layer_num, state):
+    cache = EmbedCache()
+    if cache.is_current(state.table_message, state.version):
+        return
 
     table_embed = discord.Embed(
         title="Lotus Spots",
@@ -111,10 +183,56 @@ async def _update_table_message(channel):
             value=spot.disc_table_fmt(),
             inline=False
         )
-    await state.table_message.edit(embed=table_embed, content="")
+    await cache.edit(state.table_message, state.version, table_embed)
+
+
+@traced()
+async def ensure_spot_reactions(layer, cleared=False):
+    """
+    Put a number reaction for every spot on the layers table message, skipping the ones we already added.
+    cleared is for right after its reactions were cleared, the message object doesnt know about that
+    """
+    ours = set()
+    if not cleared:
+        ours = {unqualified_emoji(reaction.emoji) for reaction in layer.table_message.reactions if reaction.me}
+    for spot_number in layer.spots:
+        emoji = NUMBER_REACTION_MAPPING[spot_number]
+        if unqualified_emoji(emoji) not in ours:
+            # One after the other so they show up in order
+            await OutboundScheduler().add_reaction(layer.table_message, emoji)
+
+
+def reset_spot_reactions(layer):
+    """
+    Clear every reaction off the layers table message and put ours back, in the background.
+    Returns the task doing it
+    """
+    return asyncio.ensure_future(_reset_spot_reactions(layer))
+
+
+async def _reset_spot_reactions(layer):
+    try:
+        await OutboundScheduler().clear_reactions(layer.table_message)
+        await ensure_spot_reactions(layer, cleared=True)
+    except Exception:
+        logger.exception(f"Failed to reset the reactions in |{layer.channel_name}|")
+
+
+def unqualified_emoji(emoji):
+    """
+    The emoji without U+FE0F, which discord may or may not include in keycaps - compare emoji this way
+    """
+    return str(emoji).replace("\N{VARIATION SELECTOR-16}", "")
+
+
+async def gather_bounded(coros, limit):
+    """
+    asyncio.gather with at most limit of the coroutines running at once. Results keep the order of coros
+    """
+    semaphore = asyncio.Semaphore(limit)
 
+    async def bounded(coro):
+        async with semaphore:
+            return await coro
 
-async def get_user_dm(user):
-    if user.dm_channel is None:
-        await user.create_dm()
-    return user.dm_channel
+    return await asyncio.gather(*[bounded(coro) for coro in coros])